@@ -0,0 +1,465 @@
+"""
+An asyncio (ASGI) serving mode of the read and rating routes of `main.app`.
+
+- Serves `/songs`, `/average_difficulty`, `/songs/<search_word>`, `PUT /ratings`
+  and `/ratings/<song_id>` with the same responses, configuration and cache,
+  but queries MongoDB with the async motor driver so that a worker keeps
+  serving other requests while waiting for the database.
+- Run it with an ASGI server, e.g.
+
+    uvicorn asgi:app --workers 4 --host 127.0.0.1 --port 8005
+"""
+
+import asyncio
+import re
+from urllib.parse import parse_qsl, quote, urlencode
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import PyMongoError
+
+import main
+from difficulty_index import HISTOGRAM_PIPELINE, DifficultyIndex
+from main import (
+    InvalidRating,
+    cache,
+    parse_rating,
+    ratings_changed,
+    song_projection,
+)
+from mongo import client_options, read_preference
+from pagination import (
+    InvalidCursor,
+    decode_cursor,
+    encode_cursor,
+    keyset_filter,
+    parse_sort,
+)
+from ratings import (
+    AGGREGATED_SONGS,
+    RATING_AGGREGATES,
+    add_rating,
+    aggregate_ratings,
+    rating_stats,
+    rating_update,
+)
+from search_index import SEARCH_FIELDS, SearchIndex
+
+config = main.app.config
+
+# The motor client of the running event loop, created on first use.
+_client = None
+_client_loop = None
+
+
+def get_db():
+    """Returns the database of `MONGO_URI` through a client of the running loop."""
+
+    global _client, _client_loop
+
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop:
+        _client = AsyncIOMotorClient(config["MONGO_URI"], **client_options(config))
+        _client_loop = loop
+    return _client.get_default_database()
+
+
+def songs_for(reads: str, primary: bool = False):
+    """Async version of `main.songs_for`."""
+
+    mode = "primary" if primary else config["MONGO_READ_PREFERENCES"][reads]
+    return get_db().get_collection(
+        "songs",
+        read_preference=read_preference(mode, config["MONGO_MAX_STALENESS_SECONDS"]),
+    )
+
+
+class Request:
+    """The parts of an ASGI HTTP request used by the handlers."""
+
+    def __init__(self, scope: dict, body: bytes):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        # Like Flask's `request.args.get`, the first value of a parameter wins.
+        self.args = {}
+        for name, value in parse_qsl(
+            scope["query_string"].decode(), keep_blank_values=True
+        ):
+            self.args.setdefault(name, value)
+        self.headers = {
+            name.decode().lower(): value.decode() for name, value in scope["headers"]
+        }
+        self.body = body
+        self.base_url = "{}://{}".format(
+            scope.get("scheme", "http"),
+            self.headers.get("host") or "{}:{}".format(*scope["server"]),
+        )
+
+    def get_json(self):
+        """Returns the decoded JSON body, or None if the body is not JSON."""
+
+        if self.headers.get("content-type", "").split(";")[0] != "application/json":
+            return None
+        try:
+            return main.app.json_provider.loads(self.body)
+        except ValueError:
+            return None
+
+    def url(self, path: str, **args) -> str:
+        """Returns the external url of `path` with the non None query `args`."""
+
+        query = urlencode(
+            {name: value for name, value in args.items() if value is not None}
+        )
+        return f"{self.base_url}{quote(path)}" + (f"?{query}" if query else "")
+
+
+async def warm_up():
+    """Builds the in-memory indexes ahead of the first requests, like `main.warm_up`."""
+
+    try:
+        difficulty_index = await load_difficulty_index()
+        await get_search_index()
+    except PyMongoError as error:
+        main.app.logger.warning("Could not warm up the in-memory indexes: %s", error)
+        return
+
+    if difficulty_index:
+        cache["difficulty"].set("histogram", difficulty_index)
+
+
+async def load_difficulty_index() -> DifficultyIndex:
+    histogram = (
+        await songs_for("difficulty").aggregate(HISTOGRAM_PIPELINE).to_list(None)
+    )
+    return DifficultyIndex((group["_id"], group["count"]) for group in histogram)
+
+
+async def get_search_index() -> SearchIndex:
+    search_index = cache["search_index"].get("songs")
+    if search_index is None:
+        search_index = SearchIndex()
+        async for song in songs_for("catalogue").find(
+            {}, {field: 1 for field in SEARCH_FIELDS}
+        ):
+            search_index.add(song)
+        cache["search_index"].set("songs", search_index)
+    return search_index
+
+
+async def list_songs(request: Request):
+    """Async version of `main.list_songs`."""
+
+    max_page_size: int = config["SONGS_MAX_PAGE_SIZE"]
+    after = request.args.get("after")
+
+    try:
+        page_size = int(request.args.get("limit", config["SONGS_PAGE_SIZE"]))
+    except ValueError:
+        page_size = 0
+    if not 1 <= page_size <= max_page_size:
+        return {
+            "error": f"Please provide a 'limit' between 1 and {max_page_size}."
+        }, 400
+
+    sort = request.args.get("sort", "_id")
+    try:
+        sort_key, sort_direction = parse_sort(sort)
+    except ValueError:
+        return {"error": f"Invalid 'sort' value '{sort}' provided."}, 400
+
+    fields = request.args.get("fields")
+    try:
+        projection = song_projection(fields)
+    except ValueError:
+        return {"error": f"Invalid 'fields' value '{fields}' provided."}, 400
+
+    hidden_field = None
+    if projection is not None and sort_key not in projection and sort_key != "_id":
+        projection[sort_key], hidden_field = 1, sort_key
+
+    try:
+        after_value, after_id = (
+            decode_cursor(sort_key, after) if after is not None else (None, None)
+        )
+    except InvalidCursor:
+        return {"error": f"Invalid 'after' value '{after}' provided."}, 400
+
+    filters = (
+        keyset_filter(sort_key, sort_direction, after_value, after_id)
+        if after_id
+        else {}
+    )
+    db_songs = await (
+        songs_for("catalogue")
+        .find(filters, projection)
+        .sort([(sort_key, sort_direction), ("_id", sort_direction)])
+        .limit(page_size)
+        .to_list(None)
+    )
+
+    if not db_songs:
+        return {"songs": [], "_links": {}}
+
+    next_cursor = encode_cursor(sort_key, db_songs[-1])
+
+    if hidden_field:
+        for song in db_songs:
+            song.pop(hidden_field, None)
+
+    options = {
+        option: request.args[option]
+        for option in ("limit", "fields", "sort")
+        if option in request.args
+    }
+
+    links = {"self": {"href": request.url("/songs", after=after, **options)}}
+    if len(db_songs) >= page_size:
+        links.update(next={"href": request.url("/songs", after=next_cursor, **options)})
+
+    return {"songs": db_songs, "_links": links}
+
+
+async def list_average_difficulty_levels(request: Request):
+    """Async version of `main.list_average_difficulty_levels`."""
+
+    try:
+        difficulty_level = float(request.args.get("level"))
+    except ValueError:
+        return {"error": "Please provide a numerical value for difficulty level."}, 400
+    except TypeError:
+        difficulty_level = "base"
+
+    difficulty_index = cache["difficulty"].get("histogram")
+    if difficulty_index is None:
+        difficulty_index = await load_difficulty_index()
+        if difficulty_index:
+            cache["difficulty"].set("histogram", difficulty_index)
+
+    if difficulty_level and difficulty_level != "base":
+        average_difficulty = difficulty_index.average(difficulty_level)
+    else:
+        average_difficulty = difficulty_index.average()
+
+    if average_difficulty is None:
+        return {"message": "No songs found to assess difficulty"}
+
+    return {
+        "difficulty_level": (
+            "All levels"
+            if difficulty_level == "base"
+            else f"Level {int(difficulty_level)} and above"
+        ),
+        "average_difficulty": round(average_difficulty, 2),
+    }
+
+
+async def get_song(request: Request, search_word: str):
+    """Async version of `main.get_song`."""
+
+    max_page_size: int = config["SEARCH_MAX_PAGE_SIZE"]
+    after = request.args.get("after")
+
+    try:
+        page_size = int(request.args.get("limit", config["SEARCH_PAGE_SIZE"]))
+    except ValueError:
+        page_size = 0
+    if not 1 <= page_size <= max_page_size:
+        return {
+            "error": f"Please provide a 'limit' between 1 and {max_page_size}."
+        }, 400
+
+    prefix = request.args.get("prefix", "false").lower() in ("1", "true")
+    fuzzy = request.args.get("fuzzy", "false").lower() in ("1", "true")
+
+    cache_key = search_word.lower()
+    if prefix:
+        cache_key += "|prefix"
+    if fuzzy:
+        cache_key += "|fuzzy"
+
+    song_ids = cache["search_words"].get(cache_key)
+    if song_ids is None:
+        song_ids = (await get_search_index()).search(
+            search_word, prefix=prefix, fuzzy=fuzzy, limit=config["SEARCH_MAX_RESULTS"]
+        )
+        if song_ids:
+            cache["search_words"].set(cache_key, song_ids)
+
+    if not song_ids:
+        return {"message": f"No songs found for '{search_word}' value."}
+
+    start = 0
+    if after is not None:
+        try:
+            start = song_ids.index(ObjectId(after)) + 1
+        except (InvalidId, TypeError, ValueError):
+            return {"error": f"Invalid 'after' value '{after}' provided."}, 400
+
+    page_ids = song_ids[start : start + page_size]
+    songs = {
+        song["_id"]: song
+        async for song in songs_for("catalogue").find({"_id": {"$in": page_ids}})
+    }
+    db_songs = [songs[song_id] for song_id in page_ids if song_id in songs]
+
+    options = {
+        option: request.args[option]
+        for option in ("limit", "prefix", "fuzzy")
+        if option in request.args
+    }
+    path = f"/songs/{search_word}"
+
+    links = {"self": {"href": request.url(path, after=after, **options)}}
+    if start + page_size < len(song_ids):
+        links.update(
+            next={"href": request.url(path, after=str(page_ids[-1]), **options)}
+        )
+
+    return {"songs": db_songs, "_links": links}
+
+
+async def add_rating_to_song(request: Request):
+    """Async version of `main.add_rating_to_song`."""
+
+    try:
+        object_id, rating_value = parse_rating(request.get_json())
+    except InvalidRating as error:
+        return {"error": error.message}, error.status_code
+
+    songs = get_db().songs
+    result = await songs.update_one(
+        {"_id": object_id, **AGGREGATED_SONGS}, rating_update(rating_value)
+    )
+    if not result.matched_count:
+        result = await songs.update_one(
+            {"_id": object_id}, {"$push": {"ratings": rating_value}}
+        )
+
+    if result.matched_count:
+        cache["ratings"].update(str(object_id), add_rating, rating_value)
+        ratings_changed([object_id])
+
+    return None, 204
+
+
+async def list_song_rating_stats(request: Request, song_id: str):
+    """Async version of `main.list_song_rating_stats`."""
+
+    try:
+        object_id = ObjectId(song_id)
+    except InvalidId:
+        return {"error": f"Invalid song_id '{song_id}' provided."}, 400
+
+    cache_key = str(object_id)
+
+    cached_aggregates = cache["ratings"].get(cache_key)
+    if cached_aggregates is not None:
+        return {"_id": song_id, **rating_stats(cached_aggregates)}
+
+    songs = songs_for("ratings", primary=cache_key in cache["recent_ratings"])
+    song_data = await songs.find_one(
+        {"_id": object_id}, {"_id": 0, **{field: 1 for field in RATING_AGGREGATES}}
+    )
+
+    if song_data is None:
+        return {"message": f"Did not find the song with id: '{song_id}'."}, 404
+
+    if "ratings_count" in song_data:
+        aggregates = song_data
+    else:
+        song_data = await songs.find_one({"_id": object_id}, {"ratings": 1, "_id": 0})
+        aggregates = aggregate_ratings(song_data.get("ratings") or [])
+
+    if not aggregates["ratings_count"]:
+        return {"message": f"No ratings found for song id '{song_id}'"}, 404
+
+    cache["ratings"].set(cache_key, aggregates)
+
+    return {"_id": song_id, **rating_stats(aggregates)}
+
+
+# The method, path pattern and handler of every route, matched in order.
+ROUTES = [
+    ("GET", re.compile(r"/songs"), list_songs),
+    ("GET", re.compile(r"/average_difficulty"), list_average_difficulty_levels),
+    ("GET", re.compile(r"/songs/(?P<search_word>[^/]+)"), get_song),
+    ("PUT", re.compile(r"/ratings"), add_rating_to_song),
+    ("GET", re.compile(r"/ratings/(?P<song_id>[^/]+)"), list_song_rating_stats),
+]
+
+NOT_FOUND = (
+    b"<h1>Not Found</h1><p>The requested URL was not found on the server.</p>",
+    404,
+)
+METHOD_NOT_ALLOWED = (
+    b"<h1>Method Not Allowed</h1>"
+    b"<p>The method is not allowed for the requested URL.</p>",
+    405,
+)
+
+
+async def dispatch(request: Request) -> tuple:
+    """Returns the content type, the body and the status code of the response."""
+
+    path_matched = False
+    for method, pattern, handler in ROUTES:
+        match = pattern.fullmatch(request.path)
+        if match is None:
+            continue
+        path_matched = True
+        if method != request.method:
+            continue
+
+        response = await handler(request, **match.groupdict())
+        body, status = response if isinstance(response, tuple) else (response, 200)
+        if body is None:
+            return "application/json", b"", status
+        return "application/json", encode_json(body), status
+
+    body, status = METHOD_NOT_ALLOWED if path_matched else NOT_FOUND
+    return "text/html; charset=utf-8", body, status
+
+
+def encode_json(body) -> bytes:
+    # Match the output of the Flask app.
+    return main.app.json_provider.dumps(body) + b"\n"
+
+
+async def app(scope, receive, send):
+    """The ASGI application."""
+
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await warm_up()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if scope["type"] != "http":
+        return
+
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+
+    content_type, response_body, status = await dispatch(Request(scope, body))
+
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", content_type.encode()),
+                (b"content-length", str(len(response_body)).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": response_body})
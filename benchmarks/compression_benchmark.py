@@ -0,0 +1,94 @@
+"""
+Compares the bytes on the wire and the CPU time of the response compression.
+
+Encodes `/songs/<search_word>` style pages of generated songs with the JSON
+provider of the app, then compresses them with every content coding at a few
+levels. Run from the repository root:
+
+    python -m benchmarks.compression_benchmark --sizes 20 100 1000
+
+A response cached by `main.conditional` is compressed once per coding, so the
+CPU time is only spent on the first request of every page and ETag.
+"""
+
+import argparse
+import random
+import time
+
+from bson.objectid import ObjectId
+
+from benchmarks.import_benchmark import ARTISTS, WORDS
+from compression import ENCODINGS, compress
+from json_provider import get_provider
+
+# The levels compared for each content coding, the app default first.
+LEVELS = {"br": (4, 1, 11), "gzip": (6, 1, 9)}
+
+
+def generate_page(size: int) -> dict:
+    """Returns a page of `size` random songs, like the body of `/songs/<search_word>`."""
+
+    rng = random.Random(42)
+    songs = [
+        {
+            "_id": ObjectId(),
+            "artist": rng.choice(ARTISTS),
+            "title": " ".join(rng.sample(WORDS, 3)),
+            "difficulty": round(rng.uniform(1, 16), 2),
+            "level": rng.randint(1, 13),
+            "released": f"{rng.randint(2000, 2021)}-{rng.randint(1, 12):02}-01",
+            "ratings": [rng.randint(1, 5) for _ in range(rng.randint(0, 20))],
+        }
+        for _ in range(size)
+    ]
+    link = "http://127.0.0.1:8005/songs/yousicians?limit={}&after={}"
+    return {
+        "songs": songs,
+        "_links": {
+            "self": {"href": link.format(size, songs[0]["_id"])},
+            "next": {"href": link.format(size, songs[-1]["_id"])},
+        },
+    }
+
+
+def cpu_time(func, repeat: int) -> float:
+    """Returns the CPU seconds taken by one call of `func`, averaged over `repeat`."""
+
+    started = time.process_time()
+    for _ in range(repeat):
+        func()
+    return (time.process_time() - started) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    provider = get_provider(sort_keys=True)
+    for size in args.sizes:
+        page = generate_page(size)
+        body = provider.dumps(page)
+        encode_time = cpu_time(lambda: provider.dumps(page), args.repeat)
+        print(
+            f"{size:>5} songs {'identity':<10} {len(body):>9} bytes"
+            f" {'100.0':>6}% encode {encode_time * 1e6:>9.1f}us"
+        )
+
+        for encoding in ENCODINGS:
+            for level in LEVELS[encoding]:
+                compressed = compress(body, encoding, level)
+                compress_time = cpu_time(
+                    lambda: compress(body, encoding, level), args.repeat
+                )
+                print(
+                    f"{size:>5} songs {f'{encoding} {level}':<10}"
+                    f" {len(compressed):>9} bytes"
+                    f" {len(compressed) / len(body) * 100:>6.1f}%"
+                    f" compress {compress_time * 1e6:>9.1f}us"
+                )
+
+
+if __name__ == "__main__":
+    main()
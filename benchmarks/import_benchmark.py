@@ -0,0 +1,85 @@
+"""
+Measures how the songs import throughput scales with the number of processes.
+
+Run from the repository root against a disposable MongoDB instance:
+
+    python -m benchmarks.import_benchmark --lines 2000000
+
+WARNING: every run drops the `songs_db` database of the given server.
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from import_data import add_data, add_data_parallel, delete_database
+
+ARTISTS = ("The Yousicians", "Mr Fastfinger", "The Yousicians Band", "Lady Ysk")
+WORDS = ("Night", "Power", "Kennel", "Metamorphosis", "Wishing", "Awaki", "Waki")
+
+
+def generate_songs(path: str, lines: int):
+    """Writes `lines` random songs.json style songs to `path`."""
+
+    rng = random.Random(42)
+    with open(path, "w") as file:
+        for _ in range(lines):
+            song = {
+                "artist": rng.choice(ARTISTS),
+                "title": " ".join(rng.sample(WORDS, 3)),
+                "difficulty": round(rng.uniform(1, 16), 2),
+                "level": rng.randint(1, 13),
+                "released": f"{rng.randint(2000, 2021)}-{rng.randint(1, 12):02}-01",
+            }
+            file.write(json.dumps(song) + "\n")
+
+
+def measure(label: str, url: str, load) -> float:
+    delete_database(url)
+    started = time.perf_counter()
+    inserted = load()
+    elapsed = time.perf_counter() - started
+    print(
+        f"{label:<22} {inserted:>10} songs {elapsed:>8.2f}s {inserted / elapsed:>12.0f} docs/sec"
+    )
+    return inserted / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--url", default="mongodb://localhost:27017/songs_db")
+    parser.add_argument("--lines", type=int, default=2_000_000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "songs.json")
+        print(f"Generating {args.lines} songs...")
+        generate_songs(path, args.lines)
+
+        baseline = measure(
+            "sequential",
+            args.url,
+            lambda: add_data(args.url, path=path, batch_size=args.batch_size),
+        )
+
+        workers = 1
+        while workers <= os.cpu_count():
+            throughput = measure(
+                f"parallel ({workers} workers)",
+                args.url,
+                lambda: add_data_parallel(
+                    args.url, path=path, workers=workers, batch_size=args.batch_size
+                ),
+            )
+            print(f"{'':<22} speedup x{throughput / baseline:.2f}")
+            workers *= 2
+
+    delete_database(args.url)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Compares the request latency of running servers under concurrent load.
+
+Start the WSGI and the ASGI servers against the same imported database, e.g.
+
+    gunicorn main:app -w 4 -b 127.0.0.1:8005
+    uvicorn asgi:app --workers 4 --port 8006
+
+then run from the repository root:
+
+    python -m benchmarks.serving_benchmark http://127.0.0.1:8005 http://127.0.0.1:8006
+"""
+
+import argparse
+import statistics
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+PATHS = (
+    "/songs?limit=20",
+    "/average_difficulty?level=10",
+    "/songs/yousicians?limit=20",
+)
+
+
+def timed_get(url: str) -> float:
+    """Returns the seconds taken to fetch `url`, or None if the request failed."""
+
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url) as response:
+            response.read()
+    except (urllib.error.URLError, OSError):
+        return None
+    return time.perf_counter() - started
+
+
+def percentile(latencies: list, fraction: float) -> float:
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+
+def measure(base_url: str, path: str, requests: int, concurrency: int):
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        started = time.perf_counter()
+        results = list(executor.map(timed_get, [base_url + path] * requests))
+        elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for latency in results if latency is not None)
+    if not latencies:
+        print(f"{base_url + path:<55} all requests failed")
+        return
+
+    print(
+        f"{base_url + path:<55} {len(latencies) / elapsed:>8.0f} req/s"
+        f" p50 {statistics.median(latencies) * 1000:>7.2f}ms"
+        f" p99 {percentile(latencies, 0.99) * 1000:>7.2f}ms"
+        f" errors {len(results) - len(latencies)}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("urls", nargs="+", help="base url of each server")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+
+    for path in PATHS:
+        for base_url in args.urls:
+            # Warm the caches and the connection pools first.
+            measure(base_url.rstrip("/"), path, args.concurrency, args.concurrency)
+        for base_url in args.urls:
+            measure(base_url.rstrip("/"), path, args.requests, args.concurrency)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,537 @@
+import logging
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.managers import BaseManager
+
+logger = logging.getLogger(__name__)
+
+
+class CacheNamespace:
+    """
+    A bounded, thread safe key/value store with LRU eviction and per-entry TTL.
+
+    - `max_size` caps the number of entries; the least recently used entry
+      is evicted once the cap is reached. A `max_size` of 0 disables the namespace.
+    - `ttl` is the lifetime of an entry in seconds; `None` keeps entries
+      until they are evicted.
+    - Expired entries are kept `max_stale` more seconds, during which
+      `get_stale` still returns them so that they can be served while
+      they are recomputed (stale-while-revalidate).
+    """
+
+    def __init__(
+        self,
+        max_size: int = 1024,
+        ttl: float = None,
+        clock=time.monotonic,
+        max_stale: float = 0,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """Returns the value stored for `key`, or `default` if missing or expired."""
+
+        return self._lookup(key, default, serve_stale=False)[0]
+
+    def get_stale(self, key, default=None) -> tuple:
+        """
+        Returns the value stored for `key` and whether it is still fresh.
+
+        - Entries expired for less than `max_stale` seconds are returned as
+          stale; `default` is returned for missing and older entries.
+        """
+
+        return self._lookup(key, default, serve_stale=True)
+
+    def _lookup(self, key, default, serve_stale: bool) -> tuple:
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return default, False
+
+            value, expires_at = entry
+            now = self._clock()
+            if expires_at is not None and expires_at <= now:
+                if expires_at + self.max_stale <= now:
+                    del self._entries[key]
+                    self.expirations += 1
+                elif serve_stale:
+                    self.stale_hits += 1
+                    return value, False
+
+                self.misses += 1
+                return default, False
+
+            # Mark the entry as the most recently used one.
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value, True
+
+    def set(self, key, value, ttl: float = None):
+        """Stores `value` for `key`, evicting the least recently used entries if full."""
+
+        if self.max_size <= 0:
+            return
+
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = self._clock() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def update(self, key, func, *args) -> bool:
+        """
+        Replaces the value stored for `key` with `func(value, *args)` in place.
+
+        - The entry keeps its position and expiry, so stale entries are updated
+          too; missing entries and entries past their staleness are left alone.
+          Returns whether an entry was updated.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return False
+
+            value, expires_at = entry
+            if expires_at is not None and expires_at + self.max_stale <= self._clock():
+                return False
+
+            self._entries[key] = (func(value, *args), expires_at)
+            return True
+
+    def delete(self, key) -> bool:
+        """Removes `key` from the namespace; returns whether it was present."""
+
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def keys(self) -> list:
+        """Returns a snapshot of the keys, expired entries included."""
+
+        with self._lock:
+            return list(self._entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "max_stale": self.max_stale,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and (entry[1] is None or entry[1] > self._clock())
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class CacheBackend:
+    """
+    The storage used by `Cache`, responsible for creating its namespaces.
+
+    Namespaces must provide the `CacheNamespace` interface: `get`, `get_stale`,
+    `set`, `update`, `delete`, `clear`, `keys`, `stats`, `in` and `len`.
+    """
+
+    def namespace(self, name: str, max_size: int, ttl: float, max_stale: float = 0):
+        raise NotImplementedError
+
+
+class LocalCacheBackend(CacheBackend):
+    """Keeps the namespaces in the memory of the current process."""
+
+    def namespace(
+        self, name: str, max_size: int, ttl: float, max_stale: float = 0
+    ) -> CacheNamespace:
+        return CacheNamespace(max_size=max_size, ttl=ttl, max_stale=max_stale)
+
+
+# Namespaces living inside the shared cache server process.
+_shared_namespaces = {}
+_shared_namespaces_lock = threading.Lock()
+
+
+def _get_shared_namespace(
+    name: str, max_size: int, ttl: float, max_stale: float = 0
+) -> CacheNamespace:
+    with _shared_namespaces_lock:
+        if name not in _shared_namespaces:
+            _shared_namespaces[name] = CacheNamespace(
+                max_size=max_size, ttl=ttl, max_stale=max_stale
+            )
+        return _shared_namespaces[name]
+
+
+class SharedCacheManager(BaseManager):
+    """
+    Serves the cache namespaces to every process on the host over a local socket.
+
+    Reference for managers and proxies
+    - https://docs.python.org/3/library/multiprocessing.html#managers
+    """
+
+
+SharedCacheManager.register(
+    "get_namespace",
+    callable=_get_shared_namespace,
+    exposed=("get", "get_stale", "set", "update", "delete", "clear", "keys", "stats")
+    + ("__contains__", "__len__"),
+)
+
+
+def _remove_stale_socket(address):
+    # Remove a socket file left behind by a server that did not shut down cleanly.
+    if isinstance(address, str) and os.path.exists(address):
+        os.unlink(address)
+
+
+def start_shared_cache(address: str, authkey: bytes) -> SharedCacheManager:
+    """
+    Starts the shared cache server in a child process listening on `address`.
+
+    - Call `shutdown` on the returned manager to stop the server.
+    """
+
+    _remove_stale_socket(address)
+
+    manager = SharedCacheManager(address=address, authkey=authkey)
+    manager.start()
+    return manager
+
+
+def serve_shared_cache(address: str, authkey: bytes):
+    """Runs the shared cache server in the current process until it is killed."""
+
+    _remove_stale_socket(address)
+
+    SharedCacheManager(address=address, authkey=authkey).get_server().serve_forever()
+
+
+class SharedCacheBackend(CacheBackend):
+    """
+    Connects to a cache server started with `serve_shared_cache`
+    or `start_shared_cache`, so that all
+    the workers of a host share one copy of every namespace.
+
+    - Connections are opened lazily and once per process, which keeps the
+      backend safe to create before gunicorn forks its workers.
+    - Values and the functions passed to `update` travel through pickle;
+      `update` functions must therefore be importable module level functions.
+    """
+
+    def __init__(self, address: str, authkey: bytes):
+        self.address = address
+        self.authkey = authkey
+        self._manager = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def connect(self) -> SharedCacheManager:
+        with self._lock:
+            if self._manager is None or self._pid != os.getpid():
+                manager = SharedCacheManager(address=self.address, authkey=self.authkey)
+                manager.connect()
+                self._manager, self._pid = manager, os.getpid()
+            return self._manager
+
+    def namespace(
+        self, name: str, max_size: int, ttl: float, max_stale: float = 0
+    ) -> "SharedNamespace":
+        return SharedNamespace(self, name, max_size, ttl, max_stale)
+
+
+class SharedNamespace:
+    """A per-process handle on a namespace held by the shared cache server."""
+
+    def __init__(
+        self, backend: SharedCacheBackend, name: str, max_size: int, ttl, max_stale=0
+    ):
+        self._backend = backend
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._proxy = None
+        self._pid = None
+
+    def _namespace(self):
+        if self._proxy is None or self._pid != os.getpid():
+            manager = self._backend.connect()
+            self._proxy = manager.get_namespace(
+                self.name, self.max_size, self.ttl, self.max_stale
+            )
+            self._pid = os.getpid()
+        return self._proxy
+
+    def get(self, key, default=None):
+        return self._namespace().get(key, default)
+
+    def get_stale(self, key, default=None) -> tuple:
+        return self._namespace().get_stale(key, default)
+
+    def set(self, key, value, ttl: float = None):
+        self._namespace().set(key, value, ttl)
+
+    def update(self, key, func, *args) -> bool:
+        return self._namespace().update(key, func, *args)
+
+    def delete(self, key) -> bool:
+        return self._namespace().delete(key)
+
+    def clear(self):
+        self._namespace().clear()
+
+    def keys(self) -> list:
+        return self._namespace().keys()
+
+    def stats(self) -> dict:
+        return self._namespace().stats()
+
+    def __contains__(self, key) -> bool:
+        return self._namespace().__contains__(key)
+
+    def __len__(self) -> int:
+        return self._namespace().__len__()
+
+
+class Cache:
+    """
+    A collection of named `CacheNamespace`s configured from a mapping such as
+
+        {"ratings": {"max_size": 4096, "ttl": 60, "max_stale": 300}}
+
+    Missing settings fall back to `default_max_size` and `default_ttl`, and
+    to no staleness.
+    The namespaces are stored by `backend`, in process memory by default;
+    namespaces with `"local": True` always stay in process memory.
+    """
+
+    def __init__(
+        self,
+        namespaces: dict,
+        default_max_size: int = 1024,
+        default_ttl=None,
+        backend: CacheBackend = None,
+    ):
+        self.backend = backend or LocalCacheBackend()
+        local_backend = LocalCacheBackend()
+        self._namespaces = {
+            name: (local_backend if settings.get("local") else self.backend).namespace(
+                name,
+                max_size=settings.get("max_size", default_max_size),
+                ttl=settings.get("ttl", default_ttl),
+                max_stale=settings.get("max_stale", 0),
+            )
+            for name, settings in namespaces.items()
+        }
+
+    @classmethod
+    def from_config(cls, config) -> "Cache":
+        """Builds the cache from the `CACHE_*` settings of a Flask `app.config`."""
+
+        if config.get("CACHE_BACKEND", "local") == "shared":
+            backend = SharedCacheBackend(
+                config["CACHE_SOCKET"], config["CACHE_AUTHKEY"].encode()
+            )
+        else:
+            backend = LocalCacheBackend()
+
+        return cls(
+            config["CACHE_NAMESPACES"],
+            default_max_size=config["CACHE_DEFAULT_MAX_SIZE"],
+            default_ttl=config["CACHE_DEFAULT_TTL"],
+            backend=backend,
+        )
+
+    def __getitem__(self, name: str) -> CacheNamespace:
+        return self._namespaces[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._namespaces
+
+    def clear(self):
+        for namespace in self._namespaces.values():
+            namespace.clear()
+
+    def stats(self) -> dict:
+        return {name: ns.stats() for name, ns in self._namespaces.items()}
+
+
+def version(namespace, key) -> str:
+    """
+    Returns the version token of `key`, e.g. to build HTTP ETags.
+
+    - Tokens are random rather than counters, so that an evicted or lost
+      version gets a new token instead of reusing one clients already hold.
+    """
+
+    token = namespace.get(key)
+    if token is None:
+        token = bump_version(namespace, key)
+    return token
+
+
+def bump_version(namespace, key) -> str:
+    """Gives `key` a new version token, when the data it versions changes."""
+
+    token = secrets.token_hex(8)
+    namespace.set(key, token)
+    return token
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent computations of the same cache entry.
+
+    - The first thread missing `(namespace, key)` computes the value; the
+      threads missing the same entry meanwhile wait for its result (or its
+      exception) instead of running the same database query.
+    - `coalesced` counts the waiting calls of each namespace.
+    - Works across the threads of a process, e.g. gunicorn `gthread` workers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = {}
+
+    def do(self, namespace: str, key, func, *args):
+        """Returns `func(*args)`, computed once by concurrent calls for an entry."""
+
+        with self._lock:
+            call = self._calls.get((namespace, key))
+            leader = call is None
+            if leader:
+                call = self._calls[(namespace, key)] = _Call()
+            else:
+                self.coalesced[namespace] = self.coalesced.get(namespace, 0) + 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args)
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[(namespace, key)]
+            call.done.set()
+        return call.result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.coalesced)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Revalidator:
+    """
+    Recomputes stale cache entries on a background thread pool.
+
+    - A stale entry is refreshed once at a time, however many requests
+      served it meanwhile; `refreshes` and `failures` count the refreshes.
+    - The pool is created on first use in every process, so that gunicorn
+      workers do not inherit it from the master process.
+    """
+
+    def __init__(self, max_workers: int = 2):
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._executor = None
+        self._pid = None
+        self.refreshes = 0
+        self.failures = 0
+
+    def refresh(self, namespace: str, key, func, *args) -> bool:
+        """Runs `func(*args)` in the background; returns whether it was scheduled."""
+
+        with self._lock:
+            if (namespace, key) in self._pending:
+                return False
+            self._pending.add((namespace, key))
+
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="cache-refresh"
+                )
+                self._pid = os.getpid()
+            executor = self._executor
+
+        executor.submit(self._run, namespace, key, func, args)
+        return True
+
+    def _run(self, namespace: str, key, func, args):
+        try:
+            func(*args)
+            self.refreshes += 1
+        except Exception:
+            # The stale entry keeps being served until it is past its staleness.
+            logger.exception("Could not refresh the %s cache entry %r", namespace, key)
+            self.failures += 1
+        finally:
+            with self._lock:
+                self._pending.discard((namespace, key))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "refreshes": self.refreshes,
+                "failures": self.failures,
+            }
+
+
+if __name__ == "__main__":
+    serve_shared_cache(
+        os.environ.get("CACHE_SOCKET", "/tmp/artist_api_cache.sock"),
+        os.environ.get("CACHE_AUTHKEY", "artist_api").encode(),
+    )
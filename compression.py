@@ -0,0 +1,37 @@
+import gzip
+
+# brotli is an optional dependency; responses are only gzipped without it.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# The content codings the app compresses responses with, preferred first.
+# Reference -> https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Content-Encoding
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def negotiate(accept_encodings, size: int, min_size: int) -> str:
+    """
+    Returns the content coding to send a body of `size` bytes with, or None.
+
+    - `accept_encodings` is the parsed Accept-Encoding header of the request;
+      ties between the codings the client accepts go to `ENCODINGS` order.
+    - Bodies smaller than `min_size` are not worth compressing: the headers
+      and the compression CPU cost more than the bytes saved.
+    """
+
+    if size < min_size:
+        return None
+    return accept_encodings.best_match(ENCODINGS)
+
+
+def compress(data: bytes, encoding: str, level: int) -> bytes:
+    """Compresses `data` with one of the `ENCODINGS` at the given level."""
+
+    if encoding == "br":
+        return brotli.compress(data, quality=level)
+    if encoding == "gzip":
+        # A fixed modification time keeps the output of a body the same.
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    raise ValueError(encoding)
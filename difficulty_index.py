@@ -0,0 +1,59 @@
+from array import array
+from bisect import bisect_left
+
+# Groups the songs by difficulty on the server so that only the distinct
+# values and their counts travel over the wire.
+# Reference -> https://docs.mongodb.com/manual/reference/operator/aggregation/group/
+HISTOGRAM_PIPELINE = [
+    {"$match": {"difficulty": {"$type": "number"}}},
+    {"$group": {"_id": "$difficulty", "count": {"$sum": 1}}},
+    {"$sort": {"_id": 1}},
+]
+
+
+class DifficultyIndex:
+    """
+    A histogram of the song difficulties with prefix sums.
+
+    - `difficulties` holds the distinct difficulty values in ascending order.
+    - `counts[i]` and `sums[i]` hold the number of songs and the sum of the
+      difficulties of all the songs before `difficulties[i]`.
+
+    The count and the sum of the songs at or above any level are then found
+    with a binary search, without querying the database.
+    """
+
+    def __init__(self, histogram):
+        self.difficulties = array("d")
+        self.counts = array("q", [0])
+        self.sums = array("d", [0.0])
+
+        for difficulty, count in histogram:
+            self.difficulties.append(difficulty)
+            self.counts.append(self.counts[-1] + count)
+            self.sums.append(self.sums[-1] + difficulty * count)
+
+    @classmethod
+    def from_collection(cls, collection) -> "DifficultyIndex":
+        """Builds the index from the songs of `collection` with one aggregation."""
+
+        histogram = collection.aggregate(HISTOGRAM_PIPELINE)
+        return cls((group["_id"], group["count"]) for group in histogram)
+
+    def totals(self, level: float = None) -> tuple:
+        """Returns the count and the sum of the difficulties at or above `level`."""
+
+        start = 0 if level is None else bisect_left(self.difficulties, level)
+        return (
+            self.counts[-1] - self.counts[start],
+            self.sums[-1] - self.sums[start],
+        )
+
+    def average(self, level: float = None):
+        """Returns the average difficulty at or above `level`, or None if no song."""
+
+        count, total = self.totals(level)
+        return total / count if count else None
+
+    def __len__(self) -> int:
+        return self.counts[-1]
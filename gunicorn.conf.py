@@ -0,0 +1,47 @@
+import os
+import subprocess
+import sys
+import time
+
+# Reference for the server hooks
+# - https://docs.gunicorn.org/en/stable/settings.html#server-hooks
+shared_cache = None
+
+
+def on_starting(server):
+    """Starts the shared cache server before the workers are forked."""
+
+    global shared_cache
+
+    if os.environ.get("CACHE_BACKEND", "local") != "shared":
+        return
+
+    socket_path = os.environ.get("CACHE_SOCKET", "/tmp/artist_api_cache.sock")
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    # Run the server as a separate program so that the workers forked from this
+    # process do not inherit any multiprocessing bookkeeping about it.
+    cache_server = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache.py")
+    shared_cache = subprocess.Popen([sys.executable, cache_server])
+
+    # Wait for the socket so that the first requests do not fail to connect.
+    for _ in range(50):
+        if os.path.exists(socket_path):
+            break
+        time.sleep(0.1)
+
+    server.log.info("Started the shared cache server (pid: %s)", shared_cache.pid)
+
+
+def post_worker_init(worker):
+    """Builds the in-memory indexes of the worker before it accepts requests."""
+
+    from main import warm_up
+
+    warm_up()
+
+
+def on_exit(server):
+    if shared_cache is not None:
+        shared_cache.terminate()
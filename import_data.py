@@ -1,28 +1,475 @@
+import argparse
 import json
-import pymongo
-from pymongo import MongoClient
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from cache import bump_version
+from mongo import get_client
+from pagination import SORT_KEYS
+from search_index import SEARCH_FIELDS, tokenize, within_one_edit
+
+logger = logging.getLogger(__name__)
+
+# Types checked by `parse_song` when the attributes are present.
+TEXT_FIELDS = ("artist", "title", "released")
+NUMERIC_FIELDS = ("difficulty", "level")
+
+# Identifies a song across catalogue refreshes.
+NATURAL_KEY = ("artist", "title", "released")
 
 
 def delete_database(url="mongodb://localhost:27017/songs_db"):
-    MongoClient(url).drop_database("songs_db")
+    get_client(url).drop_database("songs_db")
+
+
+def create_indexes(songs_collection):
+    """Creates the indexes used by the API once the songs are loaded."""
+
+    # Back every sort order of the `/songs` keyset pagination. The difficulty index
+    # also serves the `$match` stage of the difficulty aggregation.
+    for sort_key in SORT_KEYS:
+        if sort_key != "_id":
+            songs_collection.create_index([(sort_key, 1), ("_id", 1)])
+    # Matches the songs of a catalogue refresh in `sync_data`.
+    songs_collection.create_index([(field, 1) for field in NATURAL_KEY])
+
+
+def parse_song(line: bytes) -> dict:
+    """
+    Parses and validates one line of a songs.json style file.
+
+    - Raises a ValueError for invalid JSON, for values other than objects, and
+      for text or numeric song attributes of the wrong type.
+    """
+
+    song = json.loads(line)
+    if not isinstance(song, dict):
+        raise ValueError("a song must be a JSON object")
+
+    for field in TEXT_FIELDS:
+        if field in song and not isinstance(song[field], str):
+            raise ValueError(f"'{field}' must be a string")
+    for field in NUMERIC_FIELDS:
+        if field in song and (
+            isinstance(song[field], bool) or not isinstance(song[field], (int, float))
+        ):
+            raise ValueError(f"'{field}' must be a number")
+
+    return song
+
+
+def read_batches(file, batch_size: int, end: int = None):
+    """
+    Yields `(songs, offset)` batches parsed from a songs.json style file.
+
+    - `file` must be opened in binary mode; `offset` is the byte position
+      right after the last line of the batch, where reading can resume.
+    - Reading stops at the first line starting at or after the `end` offset.
+    - Invalid lines are logged and skipped.
+    """
+
+    batch = []
+    # `readline` rather than iterating keeps `tell` usable on the file.
+    while end is None or file.tell() < end:
+        line = file.readline()
+        if not line:
+            break
+
+        if line.strip():
+            try:
+                batch.append(parse_song(line))
+            except ValueError as error:
+                logger.warning("Skipped the invalid song %r: %s", line[:80], error)
+
+        if len(batch) >= batch_size:
+            yield batch, file.tell()
+            batch = []
+
+    if batch:
+        yield batch, file.tell()
+
+
+def read_checkpoint(checkpoint: str) -> int:
+    try:
+        with open(checkpoint) as file:
+            return int(file.read() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def write_checkpoint(checkpoint: str, offset: int):
+    # Write to a temporary file first so that a crash never leaves a torn checkpoint.
+    with open(f"{checkpoint}.tmp", "w") as file:
+        file.write(str(offset))
+    os.replace(f"{checkpoint}.tmp", checkpoint)
+
+
+def add_data(
+    url="mongodb://localhost:27017/songs_db",
+    path="songs.json",
+    batch_size=1000,
+    checkpoint=None,
+):
+    """
+    Streams the songs of `path` into the database in batches.
+
+    - Only one batch is held in memory at a time, and each one is inserted with
+      an unordered `insert_many`.
+    - With a `checkpoint` file, the byte offset reached is saved after every
+      batch, and a later call with the same file resumes from there. The file
+      is removed once the import completes. A crash between an insert and its
+      checkpoint re-inserts that one batch on resume.
+    - Indexes are built after the load, which is faster than maintaining them
+      during it.
+    - Returns the number of songs inserted.
+    """
+
+    songs_collection = get_client(url)["songs_db"].songs
+
+    offset = read_checkpoint(checkpoint) if checkpoint else 0
+    if offset:
+        logger.info("Resuming the import of %s at byte %d", path, offset)
+
+    inserted = 0
+    started = time.perf_counter()
+
+    with open(path, "rb") as file:
+        file.seek(offset)
+
+        for songs, offset in read_batches(file, batch_size):
+            try:
+                inserted += len(
+                    songs_collection.insert_many(songs, ordered=False).inserted_ids
+                )
+            except BulkWriteError as error:
+                # The other songs of an unordered batch are still inserted.
+                inserted += error.details["nInserted"]
+                logger.warning(
+                    "%d songs of the batch ending at byte %d were rejected",
+                    len(error.details["writeErrors"]),
+                    offset,
+                )
+
+            if checkpoint:
+                write_checkpoint(checkpoint, offset)
+
+            elapsed = max(time.perf_counter() - started, 1e-9)
+            logger.info(
+                "Inserted %d songs (%.0f docs/sec)", inserted, inserted / elapsed
+            )
+
+    create_indexes(songs_collection)
+
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    return inserted
+
+
+def split_ranges(path: str, parts: int) -> list:
+    """Splits a file into at most `parts` `(start, end)` byte ranges of whole lines."""
+
+    size = os.path.getsize(path)
+    boundaries = [0]
+
+    with open(path, "rb") as file:
+        for part in range(1, parts):
+            file.seek(size * part // parts)
+            # Move the boundary to the start of the next line.
+            file.readline()
+            boundaries.append(min(file.tell(), size))
+
+    boundaries.append(size)
+    boundaries = sorted(set(boundaries))
+    return list(zip(boundaries, boundaries[1:]))
+
+
+# The client of each import worker process, created by `_init_import_worker`.
+_worker_client = None
+
 
+def _init_import_worker(url: str):
+    global _worker_client
 
-def add_data(url="mongodb://localhost:27017/songs_db"):
-    mongodb_client = MongoClient(url)
-    db = mongodb_client["songs_db"]
-    songs_collection = db.songs
+    # One connection per worker bounds the connections opened by the import.
+    _worker_client = get_client(url, maxPoolSize=1)
 
-    songs = []
-    with open("songs.json") as file:
-        for line in file.readlines():
-            songs.append(json.loads(line.strip()))
 
-    # Index the metadata attributes 'artist_lower' and 'title_lower'
-    # for text search option. https://docs.mongodb.com/manual/text-search/#text-index
-    songs_collection.create_index([("artist", pymongo.TEXT), ("title", pymongo.TEXT)])
-    songs_collection.insert_many(songs)
+def _import_range(path: str, start: int, end: int, batch_size: int) -> int:
+    songs_collection = _worker_client["songs_db"].songs
+    inserted = 0
+
+    with open(path, "rb") as file:
+        file.seek(start)
+        for songs, _ in read_batches(file, batch_size, end=end):
+            try:
+                result = songs_collection.insert_many(songs, ordered=False)
+                inserted += len(result.inserted_ids)
+            except BulkWriteError as error:
+                inserted += error.details["nInserted"]
+
+    return inserted
+
+
+def add_data_parallel(
+    url="mongodb://localhost:27017/songs_db",
+    path="songs.json",
+    workers=None,
+    batch_size=1000,
+):
+    """
+    Imports the songs of `path` with a pool of worker processes.
+
+    - The file is split into byte ranges of whole lines; each worker parses,
+      validates and inserts its ranges through its own single connection, so
+      at most `workers` connections are opened.
+    - `workers` defaults to the number of CPUs.
+    - Indexes are built once every range is loaded.
+    - Returns the number of songs inserted.
+    """
+
+    workers = workers or os.cpu_count()
+    # A few ranges per worker balance the load when some ranges are slower.
+    ranges = split_ranges(path, workers * 4)
+
+    inserted = 0
+    started = time.perf_counter()
+
+    # Reference for process pools
+    # - https://docs.python.org/3/library/concurrent.futures.html#processpoolexecutor
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_import_worker, initargs=(url,)
+    ) as executor:
+        futures = [
+            executor.submit(_import_range, path, start, end, batch_size)
+            for start, end in ranges
+        ]
+        for future in as_completed(futures):
+            inserted += future.result()
+            elapsed = max(time.perf_counter() - started, 1e-9)
+            logger.info(
+                "Inserted %d songs (%.0f docs/sec)", inserted, inserted / elapsed
+            )
+
+    create_indexes(get_client(url)["songs_db"].songs)
+
+    return inserted
+
+
+def invalidate_cache(cache, songs: list):
+    """
+    Drops the cache entries of a running app that depend on the given songs.
+
+    - The difficulty histogram is dropped if any song has a difficulty.
+    - Search results are dropped when a word of their search string is a
+      prefix of, or within one edit of, a word in the artist or the title of
+      one of the songs, which covers the prefix and fuzzy searches.
+    - Rating stats are left alone: a sync never changes ratings.
+    - The catalogue gets a new version, so conditional requests of the song
+      lists and the histogram get full responses again.
+    """
+
+    bump_version(cache["versions"], "catalogue")
+
+    if any("difficulty" in song for song in songs):
+        cache["difficulty"].delete("histogram")
+
+    tokens = set()
+    for song in songs:
+        for field in SEARCH_FIELDS:
+            tokens.update(tokenize(song.get(field, "")))
+
+    for search_word in cache["search_words"].keys():
+        if any(
+            token.startswith(word) or within_one_edit(word, token)
+            for word in tokenize(search_word)
+            for token in tokens
+        ):
+            cache["search_words"].delete(search_word)
+
+
+def sync_batch(songs_collection, songs: list) -> tuple:
+    """
+    Upserts a batch of songs matched by `NATURAL_KEY`; see `sync_data`.
+
+    - Returns the number of inserted, updated and unchanged songs and the
+      list of inserted or changed songs.
+    """
+
+    # Later duplicates of a key within the batch win.
+    by_key = {tuple(song.get(field) for field in NATURAL_KEY): song for song in songs}
+
+    existing = {
+        tuple(song.get(field) for field in NATURAL_KEY): song
+        for song in songs_collection.find(
+            {"$or": [dict(zip(NATURAL_KEY, key)) for key in by_key]}
+        )
+    }
+
+    operations, affected = [], []
+    inserted = updated = 0
+
+    for key, song in by_key.items():
+        current = existing.get(key)
+
+        if current is None:
+            operations.append(
+                UpdateOne(dict(zip(NATURAL_KEY, key)), {"$set": song}, upsert=True)
+            )
+            inserted += 1
+        else:
+            # Only the changed catalogue fields are written, so the ratings
+            # and their aggregates are kept.
+            changes = {
+                field: value
+                for field, value in song.items()
+                if field != "_id" and current.get(field) != value
+            }
+            if not changes:
+                continue
+            operations.append(UpdateOne({"_id": current["_id"]}, {"$set": changes}))
+            updated += 1
+
+        affected.append(song)
+
+    if operations:
+        songs_collection.bulk_write(operations, ordered=False)
+
+    return inserted, updated, len(by_key) - inserted - updated, affected
+
+
+def sync_data(
+    url="mongodb://localhost:27017/songs_db",
+    path="songs.json",
+    batch_size=1000,
+    cache=None,
+):
+    """
+    Incrementally refreshes the catalogue from `path` without dropping it.
+
+    - Songs are matched on their natural key (artist, title and release date);
+      new songs are inserted and only the changed fields of existing songs are
+      updated, all with unordered `bulk_write`s. Ratings are kept.
+    - With the shared `cache` of a running app, only the entries depending on
+      the inserted or changed songs are invalidated.
+    - Returns a dictionary with the number of inserted, updated and unchanged songs.
+    """
+
+    songs_collection = get_client(url)["songs_db"].songs
+    # The natural key index must exist before looking up the first batch.
+    create_indexes(songs_collection)
+
+    totals = {"inserted": 0, "updated": 0, "unchanged": 0}
+    affected = []
+
+    with open(path, "rb") as file:
+        for songs, _ in read_batches(file, batch_size):
+            inserted, updated, unchanged, batch_affected = sync_batch(
+                songs_collection, songs
+            )
+            totals["inserted"] += inserted
+            totals["updated"] += updated
+            totals["unchanged"] += unchanged
+            affected.extend(batch_affected)
+
+    if cache is not None and affected:
+        invalidate_cache(cache, affected)
+
+    logger.info(
+        "Synced %s: %d inserted, %d updated, %d unchanged",
+        path,
+        totals["inserted"],
+        totals["updated"],
+        totals["unchanged"],
+    )
+    return totals
+
+
+def backfill_rating_aggregates(url="mongodb://localhost:27017/songs_db"):
+    """
+    Computes the running rating aggregates of songs rated before they existed.
+
+    - Safe to run on a live database: each document is updated atomically from
+      its own `ratings` array with an aggregation pipeline update (MongoDB 4.2+).
+      https://docs.mongodb.com/manual/tutorial/update-documents-with-aggregation-pipeline/
+    """
+
+    songs_collection = get_client(url)["songs_db"].songs
+
+    rated = songs_collection.update_many(
+        {"ratings.0": {"$exists": True}, "ratings_count": {"$exists": False}},
+        [
+            {
+                "$set": {
+                    "ratings_count": {"$size": "$ratings"},
+                    "ratings_sum": {"$sum": "$ratings"},
+                    "ratings_min": {"$min": "$ratings"},
+                    "ratings_max": {"$max": "$ratings"},
+                }
+            }
+        ],
+    )
+    # Empty arrays get no min/max, which the first `$min`/`$max` update then sets.
+    unrated = songs_collection.update_many(
+        {"ratings": {"$exists": True}, "ratings_count": {"$exists": False}},
+        {"$set": {"ratings_count": 0, "ratings_sum": 0}},
+    )
+    return rated.modified_count + unrated.modified_count
 
 
 if __name__ == "__main__":
-    delete_database()
-    add_data()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    parser = argparse.ArgumentParser(description="Load songs.json into MongoDB.")
+    parser.add_argument("path", nargs="?", default="songs.json")
+    parser.add_argument(
+        "--batch-size", type=int, default=1000, help="songs per insert_many call"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="import with this many processes in parallel (no checkpoint support)",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="file recording the import progress; an existing one resumes it",
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="upsert the changed songs instead of reloading the whole database",
+    )
+    parser.add_argument(
+        "--backfill-ratings",
+        action="store_true",
+        help="only backfill the rating aggregates of the existing songs",
+    )
+    args = parser.parse_args()
+
+    if args.backfill_ratings:
+        print(f"Backfilled {backfill_rating_aggregates()} songs.")
+    elif args.sync:
+        app_cache = None
+        if os.environ.get("CACHE_BACKEND", "local") == "shared":
+            # The running app shares its cache; reach it with the same settings.
+            from main import cache as app_cache
+
+        sync_data(path=args.path, batch_size=args.batch_size, cache=app_cache)
+    else:
+        # Only start from an empty database when not resuming an import.
+        if not (args.checkpoint and read_checkpoint(args.checkpoint)):
+            delete_database()
+
+        if args.workers:
+            add_data_parallel(
+                path=args.path, workers=args.workers, batch_size=args.batch_size
+            )
+        else:
+            add_data(
+                path=args.path, batch_size=args.batch_size, checkpoint=args.checkpoint
+            )
@@ -0,0 +1,83 @@
+import json
+
+from bson.objectid import ObjectId
+
+# orjson is an optional dependency; the standard library is used without it.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def encode_default(value):
+    """Encodes the values JSON has no type for, such as the ObjectId of documents."""
+
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class JSONProvider:
+    """
+    Encodes and decodes the JSON bodies of the app with the `json` module.
+
+    - Output is compact UTF-8, so that every provider encodes the same
+      value to the same bytes.
+    - ObjectIds are encoded as their hexadecimal string, so documents read
+      from MongoDB are encoded as they are instead of being converted first.
+    """
+
+    name = "json"
+
+    def __init__(self, sort_keys: bool = False):
+        self.sort_keys = sort_keys
+
+    def dumps(self, value) -> bytes:
+        return json.dumps(
+            value,
+            default=encode_default,
+            ensure_ascii=False,
+            separators=(",", ":"),
+            sort_keys=self.sort_keys,
+        ).encode()
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonProvider(JSONProvider):
+    """
+    Encodes and decodes the JSON bodies of the app with orjson.
+
+    Reference -> https://github.com/ijl/orjson
+    """
+
+    name = "orjson"
+
+    def __init__(self, sort_keys: bool = False):
+        super().__init__(sort_keys)
+        self._option = orjson.OPT_SORT_KEYS if sort_keys else 0
+
+    def dumps(self, value) -> bytes:
+        return orjson.dumps(value, default=encode_default, option=self._option)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+# The providers by the name of the `JSON_PROVIDER` setting.
+PROVIDERS = {provider.name: provider for provider in (JSONProvider, OrjsonProvider)}
+
+
+def get_provider(name: str = "auto", sort_keys: bool = False) -> JSONProvider:
+    """
+    Returns the JSON provider of a name; "auto" picks orjson if it is installed.
+
+    - Raises a ValueError for unknown names and for orjson if it is missing.
+    """
+
+    if name == "auto":
+        name = "orjson" if orjson is not None else "json"
+    if name not in PROVIDERS or (name == "orjson" and orjson is None):
+        raise ValueError(name)
+    return PROVIDERS[name](sort_keys=sort_keys)
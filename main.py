@@ -1,72 +1,675 @@
+import functools
+import hmac
+import os
+import time
+
 from bson.errors import InvalidId
 from bson.objectid import ObjectId
-from flask import Flask, jsonify, request, url_for
-from flask_pymongo import PyMongo
-from pymongo.errors import OperationFailure
+from flask import (
+    Flask,
+    Response,
+    abort,
+    g,
+    jsonify,
+    request,
+    stream_with_context,
+    url_for,
+)
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import PyMongoError
+
+from cache import Cache, Revalidator, SingleFlight, bump_version, version
+from compression import compress, negotiate
+from difficulty_index import DifficultyIndex
+from json_provider import JSONProvider, get_provider
+from metrics import CONTENT_TYPE, Metrics
+from mongo import MongoConnection, client_options, read_preference, settings_from_env
+from pagination import (
+    InvalidCursor,
+    decode_cursor,
+    encode_cursor,
+    keyset_filter,
+    parse_sort,
+)
+from ratings import (
+    AGGREGATED_SONGS,
+    RATING_AGGREGATES,
+    add_rating,
+    aggregate_ratings,
+    rating_stats,
+    rating_update,
+)
+from profiler import ProfilerBusy, SamplingProfiler, format_collapsed
+from search_index import SearchIndex
+from suggest_index import SuggestIndex
+
+
+class App(Flask):
+    """
+    The Flask app, encoding the dictionaries returned by views with `json_provider`.
+
+    - Flask 2.0 always encodes them with the `json` module through `jsonify`.
+    """
+
+    json_provider: JSONProvider = None
+
+    def make_response(self, rv):
+        body, *rest = rv if isinstance(rv, tuple) else (rv,)
+        if isinstance(body, dict):
+            # Match the trailing newline of `jsonify`.
+            body = self.response_class(
+                self.json_provider.dumps(body) + b"\n",
+                mimetype=self.config["JSONIFY_MIMETYPE"],
+            )
+            rv = (body, *rest) if rest else body
+        return super().make_response(rv)
 
 
-app = Flask(__name__)
-app.config["MONGO_URI"] = "mongodb://localhost:27017/songs_db"
-mongodb_client = PyMongo(app)
-db = mongodb_client.db
+app = App(__name__)
+# "orjson" encodes large responses several times faster than the standard library
+# "json" module; "auto" uses it when it is installed.
+app.config["JSON_PROVIDER"] = os.environ.get("JSON_PROVIDER", "auto")
+app.json_provider = get_provider(
+    app.config["JSON_PROVIDER"], sort_keys=app.config["JSON_SORT_KEYS"]
+)
+app.config["MONGO_URI"] = os.environ.get(
+    "MONGO_URI", "mongodb://localhost:27017/songs_db"
+)
+# Settings of the client connection pool, overridden by the environment
+# variables of the same name. None keeps the pymongo default.
+app.config["MONGO_MAX_POOL_SIZE"] = 100
+app.config["MONGO_MIN_POOL_SIZE"] = 0
+app.config["MONGO_WAIT_QUEUE_TIMEOUT_MS"] = None
+app.config["MONGO_SERVER_SELECTION_TIMEOUT_MS"] = 30000
+# e.g. "zstd,zlib"; the server must support them as well.
+app.config["MONGO_COMPRESSORS"] = None
+app.config["MONGO_READ_PREFERENCE"] = "primary"
+app.config.update(settings_from_env())
+# Where the reads of each group of endpoints go: the "catalogue" (songs, searches
+# and exports), the "difficulty" aggregation and the "ratings" stats can be read
+# from secondaries lagging at most MONGO_MAX_STALENESS_SECONDS (90 or more) behind.
+app.config["MONGO_READ_PREFERENCES"] = {
+    reads: os.environ.get(f"MONGO_{reads.upper()}_READ_PREFERENCE", "primary")
+    for reads in ("catalogue", "difficulty", "ratings")
+}
+app.config["MONGO_MAX_STALENESS_SECONDS"] = int(
+    os.environ.get("MONGO_MAX_STALENESS_SECONDS", -1)
+)
+# One client per worker process, created on the first query after the fork.
+# Request latencies, MongoDB command durations and cache counters, see `/metrics`.
+metrics = Metrics()
+db = MongoConnection(
+    app.config["MONGO_URI"],
+    event_listeners=[metrics.command_listener()],
+    **client_options(app.config),
+)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
 
 
-# Temporary cache to house the data for quick access
-cache = {
-    "difficulty": {},
-    "search_words": {},
-    "ratings": {},
+# Flask runs the `after_request` functions in the reverse order of their
+# registration, so this one runs last and measures the compressed response.
+@app.after_request
+def record_request_metrics(response):
+    """Records the latency, the status and the body size of a request."""
+
+    started = g.get("request_started")
+    if started is not None:
+        metrics.observe_request(
+            request.url_rule.rule if request.url_rule else "unmatched",
+            request.method,
+            response.status_code,
+            time.perf_counter() - started,
+            None if response.is_streamed else response.content_length,
+        )
+    return response
+
+# Bounded LRU caches with a per-entry time to live (in seconds) for each namespace.
+# A `max_size` of 0 turns caching off for that namespace. Expired difficulty and
+# ratings entries are still served for `max_stale` seconds while they are
+# recomputed in the background.
+app.config["CACHE_DEFAULT_MAX_SIZE"] = 1024
+app.config["CACHE_DEFAULT_TTL"] = 300
+app.config["CACHE_NAMESPACES"] = {
+    "difficulty": {"max_size": 1, "ttl": 600, "max_stale": 600},
+    "search_words": {"max_size": 1024, "ttl": 300},
+    "ratings": {"max_size": 4096, "ttl": 60, "max_stale": 300},
+    # Songs rated lately, whose stats are read from the primary until the
+    # secondaries have caught up with the rating.
+    "recent_ratings": {
+        "max_size": 4096,
+        "ttl": max(app.config["MONGO_MAX_STALENESS_SECONDS"], 90),
+    },
+    # Rebuilt from the database when it expires, which picks up the songs imported
+    # since. Kept in the memory of each worker even with the shared backend.
+    "search_index": {"max_size": 1, "ttl": 300, "local": True},
+    "suggest_index": {"max_size": 1, "ttl": 300, "local": True},
+    # Version tokens of the "catalogue", of all the "ratings" and of the ratings
+    # of each song, changed on every import and rating to build the ETags, and
+    # of the "difficulty" histogram, changed when a stale one is recomputed.
+    # Without the shared backend, other workers miss the changes: expiring the
+    # tokens bounds how long they answer 304 to the previous version.
+    "versions": {"max_size": 65536, "ttl": 60},
+    # Encoded bodies of the responses answering conditional requests and their
+    # compressed variants, by URL and ETag, so that they are only encoded and
+    # compressed again once their data changed.
+    "responses": {"max_size": 2048, "ttl": 60, "local": True},
+}
+# Use the "shared" backend to share one cache between all the gunicorn workers
+# of a host through the server started by `gunicorn.conf.py`.
+app.config["CACHE_BACKEND"] = os.environ.get("CACHE_BACKEND", "local")
+app.config["CACHE_SOCKET"] = os.environ.get(
+    "CACHE_SOCKET", "/tmp/artist_api_cache.sock"
+)
+app.config["CACHE_AUTHKEY"] = os.environ.get("CACHE_AUTHKEY", "artist_api")
+cache = Cache.from_config(app.config)
+# Concurrent requests missing the same cache entry wait for a single computation.
+single_flight = SingleFlight()
+# Number of threads of each worker recomputing stale cache entries.
+app.config["CACHE_REFRESH_WORKERS"] = 2
+revalidator = Revalidator(max_workers=app.config["CACHE_REFRESH_WORKERS"])
+
+# The Cache-Control header of the read endpoints answering conditional requests.
+# The rating stats change with every rating, so caches must revalidate them.
+app.config["CACHE_CONTROL"] = {
+    "songs": "public, max-age=60",
+    "average_difficulty": "public, max-age=60",
+    "ratings": "public, no-cache",
 }
 
+# Default and maximum number of songs per page of `/songs`.
+app.config["SONGS_PAGE_SIZE"] = 5
+app.config["SONGS_MAX_PAGE_SIZE"] = 100
+
+# Default and maximum number of songs per page of `/songs/<search_word>`, and
+# number of best matches of a search kept in the cache.
+app.config["SEARCH_PAGE_SIZE"] = 20
+app.config["SEARCH_MAX_PAGE_SIZE"] = 100
+app.config["SEARCH_MAX_RESULTS"] = 1000
+
+# Default and maximum number of completions returned by `/suggest`.
+app.config["SUGGEST_SIZE"] = 10
+app.config["SUGGEST_MAX_SIZE"] = 50
+
+# JSON responses of at least `COMPRESSION_MIN_SIZE` bytes are compressed with the
+# best content coding the client accepts, at the level of that coding: gzip
+# levels go from 1 to 9, brotli levels from 0 to 11.
+app.config["COMPRESSION_MIN_SIZE"] = 1024
+app.config["COMPRESSION_LEVELS"] = {"br": 4, "gzip": 6}
+
+# `POST /profile` samples the stacks of a live worker. It only exists when enabled
+# and a token is set; the token is sent in an "Authorization: Bearer" header.
+# Captures are limited to `PROFILER_MAX_SECONDS`, below the gunicorn timeout.
+app.config["PROFILER_ENABLED"] = os.environ.get("PROFILER_ENABLED") in ("1", "true")
+app.config["PROFILER_TOKEN"] = os.environ.get("PROFILER_TOKEN")
+app.config["PROFILER_MAX_SECONDS"] = 25
+app.config["PROFILER_INTERVAL"] = 0.005
+profiler = SamplingProfiler()
+
+# Number of songs fetched per round trip by `/export/songs`.
+app.config["EXPORT_BATCH_SIZE"] = 1000
+
+# Maximum number of ratings accepted by a single `/ratings/bulk` request.
+app.config["RATINGS_BULK_MAX_ITEMS"] = 1000
+
+# The fields of a song document that clients can ask for.
+SONG_FIELDS = ("artist", "title", "difficulty", "level", "released", "ratings")
+
+
+def song_projection(fields: str = None):
+    """
+    Returns the projection for a comma separated list of song fields.
+
+    - Returns None (the full document) if no fields are given.
+    - Raises a ValueError if the list is empty or has unknown fields.
+    """
+
+    if fields is None:
+        return None
+
+    requested_fields = [field for field in fields.split(",") if field]
+    if not requested_fields or set(requested_fields) - set(SONG_FIELDS):
+        raise ValueError(fields)
+    return {field: 1 for field in requested_fields}
+
+
+def songs_for(reads: str, primary: bool = False):
+    """
+    Returns the songs collection with the read preference configured for `reads`.
+
+    - Reads from the primary regardless of the configuration if `primary` is set.
+    """
+
+    mode = "primary" if primary else app.config["MONGO_READ_PREFERENCES"][reads]
+    return db.collection(
+        "songs", read_preference(mode, app.config["MONGO_MAX_STALENESS_SECONDS"])
+    )
+
+
+def ratings_changed(song_ids):
+    """
+    Records that the given songs were rated.
+
+    - Changes the versions of their rating stats and of the song documents.
+    - Has their stats read from the primary for a while, see `songs_for`.
+    """
+
+    for song_id in song_ids:
+        bump_version(cache["versions"], f"ratings:{song_id}")
+    bump_version(cache["versions"], "ratings")
+
+    if app.config["MONGO_READ_PREFERENCES"]["ratings"] != "primary":
+        for song_id in song_ids:
+            cache["recent_ratings"].set(str(song_id), True)
+
+
+def refreshed(version_key: str, func):
+    """
+    Wraps the loader of a stale cache entry to change `version_key` once it ran.
+
+    - Responses built from the stale entry then get a new ETag and are no
+      longer served from the "responses" cache.
+    """
+
+    def load(*args):
+        value = func(*args)
+        bump_version(cache["versions"], version_key)
+        return value
+
+    return load
+
+
+def conditional(cache_control: str, *version_keys):
+    """
+    Answers conditional GET requests of a view from version tokens.
+
+    - The ETag combines the current tokens of `version_keys`; a key can also
+      be a function of the view arguments. A request whose If-None-Match
+      holds it gets a 304 without running the view.
+    - Successful responses get the ETag and the `CACHE_CONTROL` of
+      `cache_control`. Their body and its compressed variants are cached
+      until the ETag changes.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            # Read the versions first: a change while the view runs then
+            # makes the next request with this ETag get a full response.
+            etag = "-".join(
+                version(cache["versions"], key(**kwargs) if callable(key) else key)
+                for key in version_keys
+            )
+            headers = {"Cache-Control": app.config["CACHE_CONTROL"][cache_control]}
+
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304, headers=headers)
+                response.set_etag(etag, weak=True)
+                response.vary.add("Accept-Encoding")
+                return response
+
+            cache_key = f"{request.url}|{etag}"
+            body = cache["responses"].get(cache_key)
+            if body is not None:
+                response = app.response_class(
+                    body, mimetype=app.config["JSONIFY_MIMETYPE"]
+                )
+            else:
+                response = app.make_response(view(**kwargs))
+                if response.status_code == 200:
+                    cache["responses"].set(cache_key, response.get_data())
+
+            if response.status_code == 200:
+                response.headers.update(headers)
+                response.set_etag(etag, weak=True)
+            return compress_response(response, cache_key)
+
+        return wrapper
+
+    return decorator
+
+
+def compress_response(response, cache_key: str = None):
+    """
+    Compresses a JSON response with the content coding negotiated by `negotiate`.
+
+    - With a `cache_key`, the compressed body is cached in "responses" next to
+      the uncompressed one, so that cached responses are compressed once.
+    """
+
+    if (
+        response.status_code != 200
+        or response.is_streamed
+        or response.mimetype != app.config["JSONIFY_MIMETYPE"]
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    body = response.get_data()
+    encoding = negotiate(
+        request.accept_encodings, len(body), app.config["COMPRESSION_MIN_SIZE"]
+    )
+    if encoding is None:
+        return response
+
+    variant_key = f"{cache_key}|{encoding}"
+    compressed = cache["responses"].get(variant_key) if cache_key else None
+    if compressed is None:
+        level = app.config["COMPRESSION_LEVELS"][encoding]
+        compressed = compress(body, encoding, level)
+        if cache_key:
+            cache["responses"].set(variant_key, compressed)
+
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+@app.after_request
+def compress_responses(response):
+    """Compresses the responses of the views not cached by `conditional`."""
+
+    return compress_response(response)
+
+
+def get_search_index() -> SearchIndex:
+    """Returns the search index of the songs, building it on the first call."""
+
+    search_index = cache["search_index"].get("songs")
+    if search_index is None:
+        search_index = SearchIndex.from_collection(songs_for("catalogue"))
+        cache["search_index"].set("songs", search_index)
+    return search_index
+
+
+def get_suggest_index() -> SuggestIndex:
+    """Returns the autocomplete index of the songs, building it on the first call."""
+
+    suggest_index = cache["suggest_index"].get("songs")
+    if suggest_index is None:
+        suggest_index = SuggestIndex.from_collection(songs_for("catalogue"))
+        cache["suggest_index"].set("songs", suggest_index)
+        app.logger.info("Built the suggest index: %s", suggest_index.memory_usage())
+    return suggest_index
+
+
+def warm_up():
+    """
+    Builds the in-memory indexes ahead of the first requests.
+
+    - Called by `gunicorn.conf.py` once every worker has booted.
+    """
+
+    try:
+        difficulty_index = DifficultyIndex.from_collection(songs_for("difficulty"))
+        get_search_index()
+        get_suggest_index()
+    except PyMongoError as error:
+        app.logger.warning("Could not warm up the in-memory indexes: %s", error)
+        return
+
+    if difficulty_index:
+        cache["difficulty"].set("histogram", difficulty_index)
+
+
+@app.route("/cache_stats")
+def cache_stats():
+    """Returns the counters of the cache namespaces, coalesced misses and refreshes."""
+
+    return {
+        "namespaces": cache.stats(),
+        "coalesced": single_flight.stats(),
+        "refreshes": revalidator.stats(),
+    }
+
+
+@app.before_request
+def start_profiling_request():
+    if profiler.active:
+        profiler.request_started(request.url_rule.rule if request.url_rule else None)
+
+
+@app.teardown_request
+def finish_profiling_request(error):
+    if profiler.active:
+        profiler.request_finished()
+
+
+@app.route("/profile", methods=["POST"])
+def profile():
+    """
+    Samples the stacks of this worker and returns them as collapsed stacks.
+
+    - Takes an optional parameter "seconds" (the duration of the capture).
+    - Takes optional parameters "route" (a route rule such as
+      "/songs/<string:search_word>") and "requests" (default 1) to only
+      sample the next requests of that route, for at most "seconds".
+    - The other requests must be handled meanwhile, so run the worker with
+      threads (`--threads`).
+    """
+
+    token = app.config["PROFILER_TOKEN"]
+    if not app.config["PROFILER_ENABLED"] or not token:
+        abort(404)
+
+    authorization = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode()):
+        return {"error": "Please provide a valid profiler token."}, 401
+
+    max_seconds = app.config["PROFILER_MAX_SECONDS"]
+    try:
+        seconds = float(request.args.get("seconds", max_seconds))
+    except ValueError:
+        seconds = 0
+    if not 0 < seconds <= max_seconds:
+        return {"error": f"Please provide 'seconds' between 0 and {max_seconds}."}, 400
+
+    route = request.args.get("route")
+    rules = {rule.rule for rule in app.url_map.iter_rules()}
+    if route is not None and route not in rules:
+        return {"error": f"Invalid 'route' value '{route}' provided."}, 400
+
+    try:
+        requests = int(request.args.get("requests", 1))
+    except ValueError:
+        requests = 0
+    if requests < 1:
+        return {"error": "Please provide a positive number of 'requests'."}, 400
+
+    try:
+        samples = profiler.capture(
+            seconds, app.config["PROFILER_INTERVAL"], route=route, requests=requests
+        )
+    except ProfilerBusy:
+        return {"error": "A profile of this worker is already being captured."}, 409
+
+    return Response(format_collapsed(samples), mimetype="text/plain")
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    """
+    Returns the metrics of this worker in the Prometheus text format.
+
+    - Latency histograms and status counts per route, response sizes,
+      MongoDB command durations and the cache counters and hit ratios.
+    """
+
+    return Response(metrics.render(cache.stats()), content_type=CONTENT_TYPE)
+
+
+@app.route("/pool_stats")
+def pool_stats():
+    """Returns the connection pool settings and usage of this worker."""
+
+    return db.stats()
+
 
 @app.route("/songs")
+@conditional("songs", "catalogue", "ratings")
 def list_songs():
     """
     Returns a list of songs with the data provided by the "songs.json".
 
     - Add a way to paginate songs.
+    - Takes optional parameters "limit" (songs per page), "fields" (comma
+      separated fields to return), "sort" (one of `pagination.SORT_KEYS`,
+      prefixed with "-" for descending order) and "after" (the cursor
+      from the previous page).
     """
 
-    max_songs_per_page: int = 5
+    max_page_size: int = app.config["SONGS_MAX_PAGE_SIZE"]
     after = request.args.get("after")
 
+    try:
+        page_size = int(request.args.get("limit", app.config["SONGS_PAGE_SIZE"]))
+    except ValueError:
+        page_size = 0
+    if not 1 <= page_size <= max_page_size:
+        return {"error": f"Please provide a 'limit' between 1 and {max_page_size}."}, 400
+
+    sort = request.args.get("sort", "_id")
+    try:
+        sort_key, sort_direction = parse_sort(sort)
+    except ValueError:
+        return {"error": f"Invalid 'sort' value '{sort}' provided."}, 400
+
+    fields = request.args.get("fields")
+    try:
+        projection = song_projection(fields)
+    except ValueError:
+        return {"error": f"Invalid 'fields' value '{fields}' provided."}, 400
+
+    # The sort key is always fetched to build the cursor of the next page.
+    hidden_field = None
+    if projection is not None and sort_key not in projection and sort_key != "_id":
+        projection[sort_key], hidden_field = 1, sort_key
+
     # Check for a valid value of 'after' if it exists
     try:
-        after_id = ObjectId(after) if after is not None else None
-    except InvalidId:
+        after_value, after_id = (
+            decode_cursor(sort_key, after) if after is not None else (None, None)
+        )
+    except InvalidCursor:
         return {"error": f"Invalid 'after' value '{after}' provided."}, 400
 
     # Add limiting filters to the 'find' method based on the after value.
-    filters = {"_id": {"$gt": after_id}} if after_id else {}
+    filters = (
+        keyset_filter(sort_key, sort_direction, after_value, after_id)
+        if after_id
+        else {}
+    )
     # Reference for find
     # - https://pymongo.readthedocs.io/en/stable/api/pymongo/collection.html#pymongo.collection.Collection.find
-    user_songs = db.songs.find(filters).limit(max_songs_per_page)
+    user_songs = (
+        songs_for("catalogue")
+        .find(filters, projection)
+        .sort([(sort_key, sort_direction), ("_id", sort_direction)])
+        .limit(page_size)
+    )
 
-    db_songs = []
-    for song in user_songs:
-        # convert the ObjectId to a string for serialization
-        song["_id"] = str(song["_id"])
-        db_songs.append(song)
+    db_songs = list(user_songs)
 
     if not db_songs:
         return {"songs": [], "_links": {}}
 
-    # Use the last song's id from the list as the anchor
+    # Use the last song from the list as the anchor
     # to fetch the next set of songs for the next page.
-    last_song_id = str(db_songs[-1]["_id"])
+    next_cursor = encode_cursor(sort_key, db_songs[-1])
 
-    links = {"self": {"href": url_for("list_songs", after=after, _external=True)}}
+    if hidden_field:
+        for song in db_songs:
+            song.pop(hidden_field, None)
+
+    # Carry the page options over to the pagination links.
+    options = {
+        option: request.args[option]
+        for option in ("limit", "fields", "sort")
+        if option in request.args
+    }
+
+    links = {
+        "self": {
+            "href": url_for("list_songs", after=after, **options, _external=True)
+        }
+    }
 
     # Add the next link only if the result is at least equal to max result per page.
-    if len(db_songs) >= max_songs_per_page:
+    if len(db_songs) >= page_size:
         links.update(
-            next={"href": url_for("list_songs", after=last_song_id, _external=True)}
+            next={
+                "href": url_for(
+                    "list_songs", after=next_cursor, **options, _external=True
+                )
+            }
         )
 
     return {"songs": db_songs, "_links": links}
 
 
+@app.route("/export/songs")
+def export_songs():
+    """
+    Streams the whole catalogue as newline delimited JSON, one song per line.
+
+    - Takes optional parameters "fields" (comma separated fields to return)
+      and "after" (the id of the last song received, to resume an export).
+    - Songs are read in batches from a single cursor in `_id` order, so memory
+      stays constant regardless of the size of the collection.
+    """
+
+    after = request.args.get("after")
+    fields = request.args.get("fields")
+
+    try:
+        after_id = ObjectId(after) if after is not None else None
+    except InvalidId:
+        return {"error": f"Invalid 'after' value '{after}' provided."}, 400
+
+    try:
+        projection = song_projection(fields)
+    except ValueError:
+        return {"error": f"Invalid 'fields' value '{fields}' provided."}, 400
+
+    filters = {"_id": {"$gt": after_id}} if after_id else {}
+    # Reference for batch_size
+    # - https://pymongo.readthedocs.io/en/stable/api/pymongo/cursor.html#pymongo.cursor.Cursor.batch_size
+    songs = (
+        songs_for("catalogue")
+        .find(filters, projection)
+        .sort("_id", ASCENDING)
+        .batch_size(app.config["EXPORT_BATCH_SIZE"])
+    )
+
+    def generate():
+        try:
+            for song in songs:
+                yield app.json_provider.dumps(song) + b"\n"
+        finally:
+            songs.close()
+
+    # Reference for streaming responses
+    # - https://flask.palletsprojects.com/en/2.0.x/patterns/streaming/
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+def load_difficulty_index() -> DifficultyIndex:
+    """Builds the difficulty histogram and caches it."""
+
+    difficulty_index = DifficultyIndex.from_collection(songs_for("difficulty"))
+
+    # Keep an empty database uncached so that newly imported songs show up.
+    if difficulty_index:
+        cache["difficulty"].set("histogram", difficulty_index)
+    return difficulty_index
+
+
 @app.route("/average_difficulty")
+@conditional("average_difficulty", "catalogue", "difficulty")
 def list_average_difficulty_levels():
     """
     Returns the average difficulty for all songs.
@@ -86,34 +689,28 @@ def list_average_difficulty_levels():
         # TypeError occurs for None values of `level`
         difficulty_level = "base"
 
-    # Check if the data exists in the cache
-    if difficulty_level in cache["difficulty"]:
-        return {
-            "difficulty_level": "All levels"
-            if difficulty_level == "base"
-            else f"Level {int(difficulty_level)} and above",
-            "average_difficulty": cache["difficulty"][difficulty_level],
-        }
-
-    # We need only the 'difficulty' data from the collection.
-    propagation = {"difficulty": 1, "_id": 0}
+    # The histogram of all the difficulties answers any level, so that a single
+    # cache entry replaces one cached average per requested level.
+    difficulty_index, fresh = cache["difficulty"].get_stale("histogram")
+    if difficulty_index is None:
+        difficulty_index = single_flight.do(
+            "difficulty", "histogram", load_difficulty_index
+        )
+    elif not fresh:
+        revalidator.refresh(
+            "difficulty", "histogram", refreshed("difficulty", load_difficulty_index)
+        )
 
-    # Apply the filter if provided; else get everything
+    # Apply the filter if provided; else use every song
     if difficulty_level and difficulty_level != "base":
-        data = db.songs.find({"difficulty": {"$gte": difficulty_level}}, propagation)
+        average_difficulty = difficulty_index.average(difficulty_level)
     else:
-        data = db.songs.find({}, propagation)
-
-    # Get the data from the Cursor object.
-    diff_level_data = [song["difficulty"] for song in data]
+        average_difficulty = difficulty_index.average()
 
-    if not diff_level_data:
+    if average_difficulty is None:
         return {"message": "No songs found to assess difficulty"}
 
-    average_difficulty = round(sum(diff_level_data) / len(diff_level_data), 2)
-
-    # Save the data to a cache for a certain fixed amount of time.
-    cache["difficulty"][difficulty_level] = average_difficulty
+    average_difficulty = round(average_difficulty, 2)
 
     return {
         "difficulty_level": "All levels"
@@ -123,6 +720,21 @@ def list_average_difficulty_levels():
     }
 
 
+def search_songs(cache_key: str, search_word: str, prefix: bool, fuzzy: bool) -> list:
+    """Returns the ids of the best matches of a search and caches them."""
+
+    # Match the words in the in-memory inverted index.
+    song_ids = get_search_index().search(
+        search_word,
+        prefix=prefix,
+        fuzzy=fuzzy,
+        limit=app.config["SEARCH_MAX_RESULTS"],
+    )
+    if song_ids:
+        cache["search_words"].set(cache_key, song_ids)
+    return song_ids
+
+
 @app.route("/songs/<string:search_word>")
 def get_song(search_word: str):
     """
@@ -131,77 +743,326 @@ def get_song(search_word: str):
     - Takes a required parameter "message" containing the user's search string.
     - The search should take into account song's artist and title.
     - The search should be case insensitive.
+    - Matches the songs containing every word of the search string. Takes
+      optional parameters "prefix" (also match the words starting with each
+      search word) and "fuzzy" (also match the words within one typo).
+    - Returns the best matches first, a page at a time. Takes optional
+      parameters "limit" (songs per page) and "after" (the cursor from the
+      previous page).
     """
 
-    if search_word.lower() in cache["search_words"]:
-        return {"songs": cache["search_words"][search_word.lower()]}
+    max_page_size: int = app.config["SEARCH_MAX_PAGE_SIZE"]
+    after = request.args.get("after")
+
+    try:
+        page_size = int(request.args.get("limit", app.config["SEARCH_PAGE_SIZE"]))
+    except ValueError:
+        page_size = 0
+    if not 1 <= page_size <= max_page_size:
+        return {"error": f"Please provide a 'limit' between 1 and {max_page_size}."}, 400
 
-    # Use the $text search option by indexing the artist and title attributes.
-    # Reference -> https://docs.mongodb.com/manual/core/index-text/
-    result = db.songs.find({"$text": {"$search": search_word.lower()}})
+    prefix = request.args.get("prefix", "false").lower() in ("1", "true")
+    fuzzy = request.args.get("fuzzy", "false").lower() in ("1", "true")
 
-    db_songs = []
+    cache_key = search_word.lower()
+    if prefix:
+        cache_key += "|prefix"
+    if fuzzy:
+        cache_key += "|fuzzy"
 
-    try:
-        for song in result:
-            song["_id"] = str(song["_id"])
-            db_songs.append(song)
-    except OperationFailure:
-        # Should occur when there are no songs (empty db) to use `$text` search
-        # Exception - text index required for $text query
-        #             (no such collection 'songs_db.songs').
-        return {"message": f"No songs found for '{search_word}' value."}
+    # Only the ids of the best matches are cached, which bounds the size of
+    # the entries; every page is then fetched from the database.
+    song_ids = cache["search_words"].get(cache_key)
+    if song_ids is None:
+        song_ids = single_flight.do(
+            "search_words",
+            cache_key,
+            search_songs,
+            cache_key,
+            search_word,
+            prefix,
+            fuzzy,
+        )
 
     # If no songs found for the search_word, return the same message as above.
-    if not db_songs:
+    if not song_ids:
         return {"message": f"No songs found for '{search_word}' value."}
 
-    cache["search_words"][search_word.lower()] = db_songs
+    # The cursor is the id of the last song of the previous page.
+    start = 0
+    if after is not None:
+        try:
+            start = song_ids.index(ObjectId(after)) + 1
+        except (InvalidId, TypeError, ValueError):
+            return {"error": f"Invalid 'after' value '{after}' provided."}, 400
 
-    return {"songs": db_songs}
+    page_ids = song_ids[start : start + page_size]
+    songs = {
+        song["_id"]: song
+        for song in songs_for("catalogue").find({"_id": {"$in": page_ids}})
+    }
+    db_songs = [songs[song_id] for song_id in page_ids if song_id in songs]
 
+    # Carry the search options over to the pagination links.
+    options = {
+        option: request.args[option]
+        for option in ("limit", "prefix", "fuzzy")
+        if option in request.args
+    }
 
-@app.route("/ratings", methods=["PUT"])
-def add_rating_to_song():
+    links = {
+        "self": {
+            "href": url_for(
+                "get_song",
+                search_word=search_word,
+                after=after,
+                **options,
+                _external=True,
+            )
+        }
+    }
+
+    if start + page_size < len(song_ids):
+        links.update(
+            next={
+                "href": url_for(
+                    "get_song",
+                    search_word=search_word,
+                    after=str(page_ids[-1]),
+                    **options,
+                    _external=True,
+                )
+            }
+        )
+
+    return {"songs": db_songs, "_links": links}
+
+
+@app.route("/suggest")
+def suggest():
     """
-    Adds a rating for the given song.
+    Returns the artists and titles completing what the user typed so far.
 
-    - Takes required parameters "song_id" and "rating".
-    - Ratings should be between 1 and 5 inclusive.
+    - Takes a required parameter "q" with the beginning of any word of an
+      artist or a title, and an optional parameter "limit".
+    - The most rated artists and titles come first.
     """
 
-    data = request.get_json()
-    song_id = data.get("song_id")
+    max_size: int = app.config["SUGGEST_MAX_SIZE"]
+
+    query = request.args.get("q", "")
+    if not query.strip():
+        return {"error": "Please provide a 'q' value."}, 400
+
+    try:
+        limit = int(request.args.get("limit", app.config["SUGGEST_SIZE"]))
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= max_size:
+        return {"error": f"Please provide a 'limit' between 1 and {max_size}."}, 400
+
+    return {"suggestions": get_suggest_index().suggest(query, limit)}
+
+
+class InvalidRating(ValueError):
+    """Raised by `parse_rating` with the error message and status code to return."""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def parse_rating(data) -> tuple:
+    """
+    Validates a rating payload with the "song_id" and "rating" keys.
+
+    - Returns the `(ObjectId, float)` pair of the song id and the rating.
+    - Raises an InvalidRating error for missing or invalid values.
+    """
+
+    song_id = data.get("song_id") if isinstance(data, dict) else None
 
     if song_id is None:
-        return {"error": "Please provide a song id."}, 400
+        raise InvalidRating("Please provide a song id.")
 
     try:
         object_id = ObjectId(song_id)
-    except InvalidId:
-        return {"error": f"Invalid song_id '{song_id}' provided."}, 400
+    except (InvalidId, TypeError):
+        raise InvalidRating(f"Invalid song_id '{song_id}' provided.")
 
     try:
         rating_value = float(data.get("rating"))
     except TypeError:
         # Occurs if no (None) value is provided for `rating`
-        return {"error": "Please provide a rating value for the song."}, 404
+        raise InvalidRating("Please provide a rating value for the song.", 404)
     except ValueError:
         # Occurs if the rating value cannot be cast to a float
-        return {"error": "Please provide a valid numerical rating for the song."}, 400
+        raise InvalidRating("Please provide a valid numerical rating for the song.")
 
     if rating_value < 1 or rating_value > 5:
-        return {"error": "Please provide a rating between 1 and 5."}, 400
+        raise InvalidRating("Please provide a rating between 1 and 5.")
+
+    return object_id, rating_value
+
 
-    # Reference for mongodb push on arrays
-    # - https://docs.mongodb.com/manual/reference/operator/update/push/
+@app.route("/ratings", methods=["PUT"])
+def add_rating_to_song():
+    """
+    Adds a rating for the given song.
+
+    - Takes required parameters "song_id" and "rating".
+    - Ratings should be between 1 and 5 inclusive.
+    """
+
+    try:
+        object_id, rating_value = parse_rating(request.get_json())
+    except InvalidRating as error:
+        return {"error": error.message}, error.status_code
+
+    # Push the rating and maintain the running aggregates in a single atomic update.
     # NOTE: Either an update occurs or nothing gets modified.
-    db.songs.update_one({"_id": object_id}, {"$push": {"ratings": rating_value}})
+    result = db.songs.update_one(
+        {"_id": object_id, **AGGREGATED_SONGS}, rating_update(rating_value)
+    )
+
+    # Documents rated before the aggregates existed are only pushed to,
+    # until `import_data.backfill_rating_aggregates` has run.
+    if not result.matched_count:
+        result = db.songs.update_one(
+            {"_id": object_id}, {"$push": {"ratings": rating_value}}
+        )
+
+    # Fold the new rating into the cached aggregates (if any) so that the
+    # stats endpoint stays cached and still reflects this write.
+    if result.matched_count:
+        cache["ratings"].update(str(object_id), add_rating, rating_value)
+        ratings_changed([object_id])
 
     return jsonify(""), 204
 
 
+@app.route("/ratings/bulk", methods=["POST"])
+def add_ratings_to_songs():
+    """
+    Adds a batch of ratings, e.g. replayed by clients that rated songs offline.
+
+    - Takes a JSON array of {"song_id", "rating"} objects, or the same objects
+      as newline delimited JSON with the "application/x-ndjson" content type.
+    - Every item is validated like `PUT /ratings`; invalid items are reported
+      by index in "errors" while the valid ones are still applied.
+    - Valid items are applied with a single unordered `bulk_write`.
+    """
+
+    max_items: int = app.config["RATINGS_BULK_MAX_ITEMS"]
+
+    if request.mimetype == "application/x-ndjson":
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(app.json_provider.loads(line))
+            except ValueError:
+                # Keep the position of the line so that its error has an index.
+                items.append(None)
+    else:
+        items = request.get_json(silent=True)
+
+    if not isinstance(items, list):
+        return {"error": "Please provide a list of ratings."}, 400
+
+    if len(items) > max_items:
+        return {"error": f"Please provide at most {max_items} ratings at once."}, 400
+
+    ratings, errors = [], []
+    for index, item in enumerate(items):
+        try:
+            ratings.append(parse_rating(item))
+        except InvalidRating as error:
+            errors.append({"index": index, "error": error.message})
+
+    if ratings:
+        # Reference for bulk writes
+        # - https://pymongo.readthedocs.io/en/stable/examples/bulk.html
+        result = db.songs.bulk_write(
+            [
+                UpdateOne({"_id": object_id, **AGGREGATED_SONGS}, rating_update(value))
+                for object_id, value in ratings
+            ],
+            ordered=False,
+        )
+
+        # Only documents rated before the aggregates existed can be left out.
+        if result.matched_count < len(ratings):
+            legacy_ids = {
+                song["_id"]
+                for song in db.songs.find(
+                    {
+                        "_id": {"$in": [object_id for object_id, _ in ratings]},
+                        "ratings_count": {"$exists": False},
+                    },
+                    {"_id": 1},
+                )
+            }
+            if legacy_ids:
+                db.songs.bulk_write(
+                    [
+                        UpdateOne({"_id": object_id}, {"$push": {"ratings": value}})
+                        for object_id, value in ratings
+                        if object_id in legacy_ids
+                    ],
+                    ordered=False,
+                )
+
+        # Drop the cached aggregates once per rated song.
+        rated_ids = {object_id for object_id, _ in ratings}
+        for object_id in rated_ids:
+            cache["ratings"].delete(str(object_id))
+        ratings_changed(rated_ids)
+
+    return {"applied": len(ratings), "errors": errors}
+
+
+def load_rating_aggregates(object_id: ObjectId):
+    """
+    Returns the rating aggregates of a song, or None if there is no such song.
+
+    - Aggregates with at least one rating are cached.
+    """
+
+    cache_key = str(object_id)
+
+    # Read your own ratings: a secondary may not have replicated them yet.
+    songs = songs_for("ratings", primary=cache_key in cache["recent_ratings"])
+
+    # Get only the rating aggregates using the 'projection' option
+    #  - https://docs.mongodb.com/drivers/node/current/usage-examples/findOne/
+    song_data = songs.find_one(
+        {"_id": object_id}, {"_id": 0, **{field: 1 for field in RATING_AGGREGATES}}
+    )
+    if song_data is None:
+        # Stop serving the stale stats of a deleted song.
+        cache["ratings"].delete(cache_key)
+        return None
+
+    if "ratings_count" in song_data:
+        aggregates = song_data
+    else:
+        # Songs rated before the aggregates were introduced and not yet
+        # backfilled still need their full ratings array.
+        song_data = songs.find_one({"_id": object_id}, {"ratings": 1, "_id": 0})
+        aggregates = aggregate_ratings(song_data.get("ratings") or [])
+
+    # Store the data in a cache that can be periodically evicted.
+    if aggregates["ratings_count"]:
+        cache["ratings"].set(cache_key, aggregates)
+    return aggregates
+
+
 @app.route("/ratings/<string:song_id>")
+# Song ids are hexadecimal, `ratings_changed` gets their canonical lowercase form.
+@conditional("ratings", lambda song_id: f"ratings:{song_id.lower()}")
 def list_song_rating_stats(song_id: str):
     """
     Returns the average, the lowest and the highest rating
@@ -214,33 +1075,30 @@ def list_song_rating_stats(song_id: str):
     except InvalidId:
         return {"error": f"Invalid song_id '{song_id}' provided."}, 400
 
-    if song_id in cache["ratings"]:
-        return {"_id": song_id, **cache["ratings"][song_id]}
+    # Cache entries are keyed by the canonical string form of the id.
+    cache_key = str(object_id)
 
-    # Get only the ratings data using the 'projection' option
-    #  - https://docs.mongodb.com/drivers/node/current/usage-examples/findOne/
-    song_data = db.songs.find_one({"_id": object_id}, {"ratings": 1, "_id": 0})
+    cached_aggregates, fresh = cache["ratings"].get_stale(cache_key)
+    if cached_aggregates is not None:
+        if not fresh:
+            revalidator.refresh(
+                "ratings",
+                cache_key,
+                refreshed(f"ratings:{cache_key}", load_rating_aggregates),
+                object_id,
+            )
+        return {"_id": song_id, **rating_stats(cached_aggregates)}
+
+    aggregates = single_flight.do(
+        "ratings", cache_key, load_rating_aggregates, object_id
+    )
 
     # None is returned if no song is found with the requested object id.
-    if song_data is None:
+    if aggregates is None:
         return {"message": f"Did not find the song with id: '{song_id}'."}, 404
 
-    song_rating = song_data.get("ratings")
-    # We get an empty dictionary if no ratings are found
-    if not song_rating:
+    # We get a count of 0 if no ratings are found
+    if not aggregates["ratings_count"]:
         return {"message": f"No ratings found for song id '{song_id}'"}, 404
 
-    average, lowest, highest = (
-        sum(song_rating) / len(song_rating),
-        min(song_rating),
-        max(song_rating),
-    )
-
-    # Store the data in a cache that can be periodically evicted.
-    cache["ratings"][song_id]: dict = {
-        "average_rating": round(average, 2),
-        "lowest_rating": round(lowest, 2),
-        "highest_rating": round(highest, 2),
-    }
-
-    return {"_id": song_id, **cache["ratings"][song_id]}
+    return {"_id": song_id, **rating_stats(aggregates)}
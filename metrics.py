@@ -0,0 +1,255 @@
+import threading
+from bisect import bisect_left
+
+from pymongo.monitoring import CommandListener
+
+# Upper bounds of the histogram buckets, in seconds and in bytes.
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# Reference for the text format
+# - https://prometheus.io/docs/instrumenting/exposition_formats/
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    """Formats label names and values as `{name="value",...}`."""
+
+    if not names:
+        return ""
+    pairs = (
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in zip(names, values)
+    )
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A Prometheus counter, with one series per tuple of label values."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, label_names: tuple = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> list:
+        with self._lock:
+            return [
+                (self.name, format_labels(self.label_names, labels), value)
+                for labels, value in self._values.items()
+            ]
+
+    def render(self) -> list:
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.kind}",
+            *(
+                f"{name}{labels} {format_value(value)}"
+                for name, labels, value in self.samples()
+            ),
+        ]
+
+
+class Histogram(Counter):
+    """
+    A Prometheus histogram, with one series per tuple of label values.
+
+    - Each series keeps a count per bucket and the sum of the observations;
+      the cumulative bucket counts are only computed when rendered.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, description: str, label_names: tuple = (), buckets=()
+    ):
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels: tuple, value: float):
+        # Bucket `i` counts the values up to `buckets[i]`; the last one the rest.
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0]
+            series[0][index] += 1
+            series[1] += value
+
+    def samples(self) -> list:
+        with self._lock:
+            values = {
+                labels: (list(counts), total)
+                for labels, (counts, total) in self._values.items()
+            }
+
+        samples = []
+        for labels, (counts, total) in values.items():
+            count = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                count += bucket_count
+                samples.append(
+                    (
+                        f"{self.name}_bucket",
+                        format_labels(
+                            (*self.label_names, "le"), (*labels, format_value(bound))
+                        ),
+                        count,
+                    )
+                )
+            label_text = format_labels(self.label_names, labels)
+            samples.append((f"{self.name}_sum", label_text, total))
+            samples.append((f"{self.name}_count", label_text, count))
+        return samples
+
+
+class CommandTimer(CommandListener):
+    """
+    Times the commands a MongoDB client sends, by command name.
+
+    - The driver measures each command itself, so this only records the
+      duration it reports once the reply arrives.
+    """
+
+    def __init__(self, durations: Histogram, failures: Counter):
+        self.durations = durations
+        self.failures = failures
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.durations.observe((event.command_name,), event.duration_micros / 1e6)
+
+    def failed(self, event):
+        self.durations.observe((event.command_name,), event.duration_micros / 1e6)
+        self.failures.inc((event.command_name,))
+
+
+class Metrics:
+    """
+    The request, MongoDB and cache metrics of a worker, in the Prometheus format.
+
+    - Requests and commands are recorded as they happen, with a lock and a
+      binary search per observation. Cache counters are only read from the
+      cache when the metrics are rendered.
+    """
+
+    def __init__(self, prefix: str = "artist_api"):
+        self.requests = Counter(
+            f"{prefix}_requests_total",
+            "Requests handled, by route, method and status.",
+            ("route", "method", "status"),
+        )
+        self.request_duration = Histogram(
+            f"{prefix}_request_duration_seconds",
+            "Time taken to handle a request, by route and method.",
+            ("route", "method"),
+            LATENCY_BUCKETS,
+        )
+        self.response_size = Histogram(
+            f"{prefix}_response_size_bytes",
+            "Size of the response bodies sent, by route.",
+            ("route",),
+            SIZE_BUCKETS,
+        )
+        self.command_duration = Histogram(
+            f"{prefix}_mongodb_command_duration_seconds",
+            "Time taken by the MongoDB commands, by command name.",
+            ("command",),
+            LATENCY_BUCKETS,
+        )
+        self.command_failures = Counter(
+            f"{prefix}_mongodb_command_failures_total",
+            "MongoDB commands that failed, by command name.",
+            ("command",),
+        )
+        self.prefix = prefix
+
+    def command_listener(self) -> CommandTimer:
+        """Returns the pymongo listener recording the command durations."""
+
+        return CommandTimer(self.command_duration, self.command_failures)
+
+    def observe_request(
+        self, route: str, method: str, status: int, duration: float, size: int = None
+    ):
+        """Records a handled request; `size` is None for streamed responses."""
+
+        self.requests.inc((route, method, status))
+        self.request_duration.observe((route, method), duration)
+        if size is not None:
+            self.response_size.observe((route,), size)
+
+    def render(self, cache_stats: dict = None) -> str:
+        """Returns every metric, with the counters of the given cache namespaces."""
+
+        lines = []
+        for metric in (
+            self.requests,
+            self.request_duration,
+            self.response_size,
+            self.command_duration,
+            self.command_failures,
+        ):
+            lines.extend(metric.render())
+
+        if cache_stats:
+            lines.extend(self._render_cache(cache_stats))
+        return "\n".join(lines) + "\n"
+
+    def _render_cache(self, cache_stats: dict) -> list:
+        lines = []
+        for counter in ("hits", "stale_hits", "misses", "evictions", "expirations"):
+            metric = Counter(
+                f"{self.prefix}_cache_{counter}_total",
+                f"Cache {counter.replace('_', ' ')}, by namespace.",
+                ("namespace",),
+            )
+            for namespace, stats in cache_stats.items():
+                metric.inc((namespace,), stats[counter])
+            lines.extend(metric.render())
+
+        lines.append(
+            f"# HELP {self.prefix}_cache_hit_ratio"
+            " Share of the cache lookups served from the cache, by namespace."
+        )
+        lines.append(f"# TYPE {self.prefix}_cache_hit_ratio gauge")
+        for namespace, stats in cache_stats.items():
+            hits = stats["hits"] + stats["stale_hits"]
+            lookups = hits + stats["misses"]
+            ratio = hits / lookups if lookups else 0.0
+            lines.append(
+                f"{self.prefix}_cache_hit_ratio"
+                f"{format_labels(('namespace',), (namespace,))} {format_value(ratio)}"
+            )
+        return lines
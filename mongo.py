@@ -0,0 +1,213 @@
+import os
+import threading
+from collections import defaultdict
+
+from pymongo import MongoClient
+from pymongo.monitoring import ConnectionPoolListener
+from pymongo.read_preferences import (
+    Nearest,
+    Primary,
+    PrimaryPreferred,
+    Secondary,
+    SecondaryPreferred,
+)
+
+# The config keys of the MongoDB client settings, with the matching
+# `MongoClient` option and the type of their environment variable.
+# Reference -> https://pymongo.readthedocs.io/en/stable/api/pymongo/mongo_client.html
+CLIENT_SETTINGS = {
+    "MONGO_MAX_POOL_SIZE": ("maxPoolSize", int),
+    "MONGO_MIN_POOL_SIZE": ("minPoolSize", int),
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": ("waitQueueTimeoutMS", int),
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": ("serverSelectionTimeoutMS", int),
+    "MONGO_COMPRESSORS": ("compressors", str),
+    "MONGO_READ_PREFERENCE": ("readPreference", str),
+}
+
+
+def settings_from_env(environ=os.environ) -> dict:
+    """Returns the `CLIENT_SETTINGS` set by environment variables of the same name."""
+
+    return {
+        key: cast(environ[key])
+        for key, (_, cast) in CLIENT_SETTINGS.items()
+        if environ.get(key)
+    }
+
+
+# The read preference modes by their name in the `readPreference` option.
+# Reference -> https://docs.mongodb.com/manual/core/read-preference/
+READ_PREFERENCES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+
+def read_preference(mode: str, max_staleness: int = -1):
+    """
+    Returns the pymongo read preference of a mode name such as "secondaryPreferred".
+
+    - Secondaries lagging more than `max_staleness` seconds behind the primary
+      are not read from; -1 means no limit. MongoDB requires at least 90.
+    - Raises a ValueError for unknown modes.
+    """
+
+    if mode not in READ_PREFERENCES:
+        raise ValueError(mode)
+    if mode == "primary":
+        return Primary()
+    return READ_PREFERENCES[mode](max_staleness=max_staleness)
+
+
+def client_options(config) -> dict:
+    """Returns the `MongoClient` options of the `CLIENT_SETTINGS` of a config."""
+
+    return {
+        option: config[key]
+        for key, (option, _) in CLIENT_SETTINGS.items()
+        if config.get(key) is not None
+    }
+
+
+class PoolStats(ConnectionPoolListener):
+    """
+    Counts the connections of the pool of every server.
+
+    - "open" and "in_use" are the connections currently open and checked out,
+      "waiting" the threads waiting for a connection.
+    - "checkouts" and "checkout_failures" are running totals; failures are
+      mostly wait queue timeouts of a saturated pool.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._servers = defaultdict(
+            lambda: dict.fromkeys(
+                ("open", "in_use", "waiting", "checkouts", "checkout_failures"), 0
+            )
+        )
+
+    def _count(self, event, **changes):
+        address = "{}:{}".format(*event.address)
+        with self._lock:
+            counters = self._servers[address]
+            for name, change in changes.items():
+                counters[name] += change
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                address: dict(counters) for address, counters in self._servers.items()
+            }
+
+    def pool_created(self, event):
+        self._count(event)
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._count(event, open=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._count(event, open=-1)
+
+    def connection_check_out_started(self, event):
+        self._count(event, waiting=1)
+
+    def connection_check_out_failed(self, event):
+        self._count(event, waiting=-1, checkout_failures=1)
+
+    def connection_checked_out(self, event):
+        self._count(event, waiting=-1, in_use=1, checkouts=1)
+
+    def connection_checked_in(self, event):
+        self._count(event, in_use=-1)
+
+
+class MongoConnection:
+    """
+    The client of a MongoDB database, shared by every thread of a process.
+
+    - The client is only created on first use, so that each gunicorn worker
+      creates its own after the fork instead of inheriting the sockets of the
+      master process; a forked child also gets a new one.
+    - Attributes are looked up on the default database of `uri`, so the
+      connection is used like a pymongo `Database`, e.g. `db.songs.find()`.
+    - `event_listeners` are registered on the client next to `pool_stats`.
+    """
+
+    def __init__(self, uri: str, event_listeners=(), **options):
+        self.uri = uri
+        self.options = options
+        self.event_listeners = list(event_listeners)
+        self.pool_stats = PoolStats()
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self) -> MongoClient:
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    # Counters inherited from the parent process are meaningless.
+                    self.pool_stats = PoolStats()
+                    self._client = MongoClient(
+                        self.uri,
+                        event_listeners=[self.pool_stats, *self.event_listeners],
+                        **self.options,
+                    )
+                    self._pid = os.getpid()
+        return self._client
+
+    @property
+    def database(self):
+        return self.client.get_default_database()
+
+    def collection(self, name: str, read_preference=None):
+        """Returns a collection of the database with another read preference."""
+
+        return self.database.get_collection(name, read_preference=read_preference)
+
+    def __getattr__(self, name: str):
+        # Private names are never collections; this also avoids recursing on
+        # the attributes of a half initialized or unpickled instance.
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.database, name)
+
+    def __getitem__(self, name: str):
+        return self.database[name]
+
+    def stats(self) -> dict:
+        """Returns the pool settings and the connection counters of every server."""
+
+        return {
+            "max_pool_size": self.options.get("maxPoolSize", 100),
+            "min_pool_size": self.options.get("minPoolSize", 0),
+            "servers": self.pool_stats.snapshot(),
+        }
+
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def get_client(uri: str, **options) -> MongoClient:
+    """Returns the client of the process for `uri` and `options`, creating it once."""
+
+    key = (uri, tuple(sorted(options.items())))
+    with _connections_lock:
+        if key not in _connections:
+            _connections[key] = MongoConnection(uri, **options)
+    return _connections[key].client
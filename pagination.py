@@ -0,0 +1,102 @@
+import base64
+import datetime
+
+from bson import json_util
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING
+
+# Keys the songs can be paginated on; each one is backed by an index on
+# `(key, _id)` created in `import_data.add_data`.
+SORT_KEYS = ("_id", "difficulty", "released")
+
+CURSOR_VALUE_TYPES = (str, int, float, datetime.datetime, type(None))
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor cannot be decoded."""
+
+
+def parse_sort(sort: str) -> tuple:
+    """
+    Parses a sort parameter such as "difficulty" or "-released".
+
+    - Returns the key and the pymongo direction; a leading "-" sorts descending.
+    - Raises a ValueError for keys that are not in `SORT_KEYS`.
+    """
+
+    key, direction = (
+        (sort[1:], DESCENDING) if sort.startswith("-") else (sort, ASCENDING)
+    )
+    if key not in SORT_KEYS:
+        raise ValueError(key)
+    return key, direction
+
+
+def encode_cursor(key: str, song: dict) -> str:
+    """
+    Returns the opaque cursor pointing right after `song` in the `key` order.
+
+    - `_id` cursors stay plain ObjectId strings, so older links keep working.
+    - Other cursors hold the sort value and the id, which breaks ties between
+      songs sharing the same value, as url safe base64 of Extended JSON.
+    """
+
+    if key == "_id":
+        return str(song["_id"])
+
+    payload = json_util.dumps([key, song.get(key), song["_id"]])
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(key: str, cursor: str) -> tuple:
+    """Returns the `(value, ObjectId)` position stored in a cursor for `key`."""
+
+    if key == "_id":
+        try:
+            return None, ObjectId(cursor)
+        except (InvalidId, TypeError) as error:
+            raise InvalidCursor(cursor) from error
+
+    try:
+        payload = base64.urlsafe_b64decode(cursor.encode())
+        cursor_key, value, song_id = json_util.loads(payload)
+    except (ValueError, TypeError, InvalidId) as error:
+        raise InvalidCursor(cursor) from error
+
+    # Only accept plain values, so that a crafted cursor cannot smuggle query
+    # operators such as {"$ne": null} into the keyset filter.
+    if (
+        cursor_key != key
+        or not isinstance(song_id, ObjectId)
+        or not isinstance(value, CURSOR_VALUE_TYPES)
+    ):
+        raise InvalidCursor(cursor)
+    return value, song_id
+
+
+def keyset_filter(key: str, direction: int, value, song_id: ObjectId) -> dict:
+    """
+    Returns the filter selecting the songs after `(value, song_id)` when sorted
+    by `[(key, direction), ("_id", direction)]`.
+
+    - Songs missing `key` sort first in ascending order and last in descending
+      order, the way MongoDB orders null values.
+    """
+
+    id_after = {"$gt" if direction == ASCENDING else "$lt": song_id}
+
+    if key == "_id":
+        return {"_id": id_after}
+
+    same_value = {key: value, "_id": id_after}
+
+    if value is None:
+        # Every song with a value comes after the nulls in ascending order only.
+        if direction == ASCENDING:
+            return {"$or": [same_value, {key: {"$ne": None}}]}
+        return same_value
+
+    if direction == ASCENDING:
+        return {"$or": [{key: {"$gt": value}}, same_value]}
+    return {"$or": [{key: {"$lt": value}}, same_value, {key: None}]}
@@ -0,0 +1,112 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class ProfilerBusy(Exception):
+    """Raised when a capture is requested while another one is running."""
+
+
+def collapse(frame) -> str:
+    """
+    Returns the stack of a frame as a line of the collapsed stack format.
+
+    - Frames are "file:function", separated by ";" from the outermost one,
+      the format read by flamegraph.pl and speedscope.
+    """
+
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """
+    Samples the Python stacks of the other threads of this process.
+
+    - A capture samples the stacks every `interval` seconds from the thread
+      asking for it, either of every thread for a number of seconds, or only
+      of the threads handling the next requests of a route.
+    - Nothing runs between captures: the request hooks only read `active`.
+    """
+
+    def __init__(self):
+        self.active = False
+        self._capture_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._route = None
+        self._threads = set()
+        self._remaining = 0
+        self._done = threading.Event()
+
+    def request_started(self, route: str):
+        """Has the current thread sampled if it handles the route being profiled."""
+
+        if route is not None and route == self._route:
+            with self._lock:
+                if self._remaining > len(self._threads):
+                    self._threads.add(threading.get_ident())
+
+    def request_finished(self):
+        ident = threading.get_ident()
+        with self._lock:
+            if ident in self._threads:
+                self._threads.discard(ident)
+                self._remaining -= 1
+                if self._remaining <= 0:
+                    self._done.set()
+
+    def capture(
+        self, seconds: float, interval: float, route: str = None, requests: int = 0
+    ) -> Counter:
+        """
+        Returns the number of samples of each collapsed stack.
+
+        - With a `route`, only the next `requests` requests of that route are
+          sampled, for at most `seconds`.
+        - Raises ProfilerBusy if another capture is running.
+        """
+
+        if not self._capture_lock.acquire(blocking=False):
+            raise ProfilerBusy()
+
+        try:
+            with self._lock:
+                self._route = route
+                self._threads = set()
+                self._remaining = requests
+                self._done.clear()
+            self.active = True
+
+            own_ident = threading.get_ident()
+            samples = Counter()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline and not self._done.is_set():
+                if route is not None:
+                    with self._lock:
+                        threads = set(self._threads)
+                for ident, frame in sys._current_frames().items():
+                    if ident == own_ident or (
+                        route is not None and ident not in threads
+                    ):
+                        continue
+                    samples[collapse(frame)] += 1
+                self._done.wait(interval)
+            return samples
+        finally:
+            self.active = False
+            with self._lock:
+                self._route = None
+                self._threads = set()
+            self._capture_lock.release()
+
+
+def format_collapsed(samples: Counter) -> str:
+    """Formats the samples as "stack count" lines, the most sampled first."""
+
+    return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
@@ -0,0 +1,65 @@
+# Running aggregates kept on every song document next to its `ratings` array.
+RATING_AGGREGATES = ("ratings_count", "ratings_sum", "ratings_min", "ratings_max")
+
+# Matches the songs whose aggregates are up to date: either maintained already or
+# not rated yet. Songs rated before the aggregates existed need a backfill first.
+AGGREGATED_SONGS = {
+    "$or": [
+        {"ratings_count": {"$exists": True}},
+        {"ratings": {"$exists": False}},
+    ]
+}
+
+
+def rating_update(rating_value: float) -> dict:
+    """
+    Returns the update pushing a rating and maintaining the running aggregates.
+
+    Reference for mongodb push on arrays and field update operators
+    - https://docs.mongodb.com/manual/reference/operator/update/push/
+    - https://docs.mongodb.com/manual/reference/operator/update-field/
+    """
+
+    return {
+        "$push": {"ratings": rating_value},
+        "$inc": {"ratings_count": 1, "ratings_sum": rating_value},
+        "$min": {"ratings_min": rating_value},
+        "$max": {"ratings_max": rating_value},
+    }
+
+
+def aggregate_ratings(ratings: list) -> dict:
+    """Computes the rating aggregates from a full list of ratings."""
+
+    if not ratings:
+        return {"ratings_count": 0, "ratings_sum": 0}
+
+    return {
+        "ratings_count": len(ratings),
+        "ratings_sum": sum(ratings),
+        "ratings_min": min(ratings),
+        "ratings_max": max(ratings),
+    }
+
+
+def add_rating(aggregates: dict, rating_value: float) -> dict:
+    """Returns new rating aggregates with `rating_value` taken into account."""
+
+    return {
+        "ratings_count": aggregates["ratings_count"] + 1,
+        "ratings_sum": aggregates["ratings_sum"] + rating_value,
+        "ratings_min": min(aggregates["ratings_min"], rating_value),
+        "ratings_max": max(aggregates["ratings_max"], rating_value),
+    }
+
+
+def rating_stats(aggregates: dict) -> dict:
+    """Converts the rating aggregates of a song to the public stats format."""
+
+    return {
+        "average_rating": round(
+            aggregates["ratings_sum"] / aggregates["ratings_count"], 2
+        ),
+        "lowest_rating": round(aggregates["ratings_min"], 2),
+        "highest_rating": round(aggregates["ratings_max"], 2),
+    }
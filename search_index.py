@@ -0,0 +1,211 @@
+import heapq
+import math
+import re
+from array import array
+from bisect import bisect_left
+
+# Song attributes searched by `/songs/<search_word>`.
+SEARCH_FIELDS = ("artist", "title")
+
+# Share of a word's weight given to the songs that only match it by prefix or typo.
+PARTIAL_MATCH_WEIGHT = 0.5
+
+
+def tokenize(text) -> list:
+    """Returns the lowercased words of a text, in order."""
+
+    return re.findall(r"\w+", str(text).lower())
+
+
+def within_one_edit(first: str, second: str) -> bool:
+    """Returns whether two words differ by at most one insertion, deletion or change."""
+
+    if abs(len(first) - len(second)) > 1:
+        return False
+    if len(first) > len(second):
+        first, second = second, first
+
+    # Skip the common prefix, then compare what is left after the first difference.
+    index = 0
+    while index < len(first) and first[index] == second[index]:
+        index += 1
+
+    if len(first) == len(second):
+        return first[index + 1 :] == second[index + 1 :]
+    return first[index:] == second[index + 1 :]
+
+
+def intersect(first: array, second: array) -> array:
+    """Intersects two sorted posting lists."""
+
+    result = array("I")
+    i = j = 0
+    while i < len(first) and j < len(second):
+        if first[i] == second[j]:
+            result.append(first[i])
+            i += 1
+            j += 1
+        elif first[i] < second[j]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+class SearchIndex:
+    """
+    An in-memory inverted index over the artist and title words of the songs.
+
+    - Every song gets a sequential number; each word maps to the sorted array
+      of the numbers of the songs containing it (its posting list).
+    - A query matches the songs containing all of its words (AND). A word can
+      also match the longer words it is a prefix of, and the words within one
+      edit of it (fuzzy matching).
+    - Matches are ranked by the sum of the inverse document frequencies of
+      the words they contain, so that rare words weigh more, the way MongoDB
+      scores `$text` searches. Prefix and fuzzy matches weigh less.
+    """
+
+    def __init__(self):
+        self.song_ids = []
+        self._numbers = {}
+        self._postings = {}
+        self._vocabulary = None
+        self._deletions = None
+
+    @classmethod
+    def from_collection(cls, collection) -> "SearchIndex":
+        """Builds the index from the artist and title of every song of `collection`."""
+
+        index = cls()
+        for song in collection.find({}, {field: 1 for field in SEARCH_FIELDS}):
+            index.add(song)
+        return index
+
+    def add(self, song: dict):
+        """Indexes a song, replacing the previous version of an already indexed one."""
+
+        previous = self._numbers.get(song["_id"])
+        if previous is not None:
+            # Leave a tombstone; numbers only grow so posting lists stay sorted.
+            self.song_ids[previous] = None
+
+        number = len(self.song_ids)
+        self.song_ids.append(song["_id"])
+        self._numbers[song["_id"]] = number
+
+        tokens = set()
+        for field in SEARCH_FIELDS:
+            tokens.update(tokenize(song.get(field, "")))
+
+        for token in tokens:
+            if token not in self._postings:
+                self._postings[token] = array("I")
+                self._vocabulary = self._deletions = None
+            self._postings[token].append(number)
+
+    def _vocabulary_from(self, prefix: str) -> list:
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self._postings)
+
+        start = bisect_left(self._vocabulary, prefix)
+        words = []
+        for word in self._vocabulary[start:]:
+            if not word.startswith(prefix):
+                break
+            words.append(word)
+        return words
+
+    def _fuzzy_words(self, token: str) -> set:
+        # Index every word under its single character deletions, so that the
+        # words within one edit of `token` share one of its own deletions.
+        if self._deletions is None:
+            self._deletions = {}
+            for word in self._postings:
+                for variant in {word} | _deletions(word):
+                    self._deletions.setdefault(variant, []).append(word)
+
+        candidates = set()
+        for variant in {token} | _deletions(token):
+            candidates.update(self._deletions.get(variant, ()))
+        return {word for word in candidates if within_one_edit(token, word)}
+
+    def _matches(self, token: str, prefix: bool, fuzzy: bool) -> dict:
+        # Maps the words matched by `token` to the weight of the match.
+        words = {}
+        if prefix:
+            words.update(
+                dict.fromkeys(self._vocabulary_from(token), PARTIAL_MATCH_WEIGHT)
+            )
+        if fuzzy:
+            words.update(dict.fromkeys(self._fuzzy_words(token), PARTIAL_MATCH_WEIGHT))
+        if token in self._postings:
+            words[token] = 1.0
+        return words
+
+    def _union(self, words) -> array:
+        if len(words) == 1:
+            return self._postings[next(iter(words))]
+
+        numbers = set()
+        for word in words:
+            numbers.update(self._postings[word])
+        return array("I", sorted(numbers))
+
+    def search(
+        self, query: str, prefix: bool = False, fuzzy: bool = False, limit: int = None
+    ) -> list:
+        """
+        Returns the ids of the songs matching every word of `query`, best first.
+
+        - Only the `limit` best songs are returned if a limit is given.
+        """
+
+        matches = [
+            self._matches(token, prefix, fuzzy) for token in set(tokenize(query))
+        ]
+        if not matches or not all(matches):
+            return []
+
+        # Start from the shortest posting lists to keep the intersections small.
+        postings = sorted((self._union(words) for words in matches), key=len)
+        numbers = postings[0]
+        for posting in postings[1:]:
+            if not numbers:
+                break
+            numbers = intersect(numbers, posting)
+
+        scores = {
+            number: 0.0 for number in numbers if self.song_ids[number] is not None
+        }
+        if not scores:
+            return []
+
+        for words in matches:
+            # A song scores the best of the words it matches for each query word.
+            best = {}
+            for word, weight in words.items():
+                posting = self._postings[word]
+                score = weight * math.log(1 + len(self.song_ids) / len(posting))
+                for number in posting:
+                    if number in scores and best.get(number, 0.0) < score:
+                        best[number] = score
+            for number, score in best.items():
+                scores[number] += score
+
+        # Ties keep the indexing order.
+        def rank(number):
+            return -scores[number], number
+
+        if limit is None:
+            ranked = sorted(scores, key=rank)
+        else:
+            ranked = heapq.nsmallest(limit, scores, key=rank)
+        return [self.song_ids[number] for number in ranked]
+
+    def __len__(self) -> int:
+        return len(self._numbers)
+
+
+def _deletions(word: str) -> set:
+    return {word[:index] + word[index + 1 :] for index in range(len(word))}
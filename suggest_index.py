@@ -0,0 +1,137 @@
+import heapq
+import sys
+from array import array
+from bisect import bisect_left
+
+from search_index import SEARCH_FIELDS, tokenize
+
+# Prefixes this short match most of the index, so their completions are kept.
+SHORT_PREFIX_LENGTH = 2
+
+
+class SuggestIndex:
+    """
+    A sorted array prefix index of the artist and title strings of the songs.
+
+    - Every distinct artist or title is an entry, with the total number of
+      ratings of its songs as its popularity.
+    - `keys` holds the normalized entries and their suffixes starting at each
+      word in sorted order, so that "nig" completes "Wishing In The Night".
+      `key_entries[i]` is the number of the entry of `keys[i]`.
+
+    The keys starting with a prefix are then found with two binary searches.
+    """
+
+    def __init__(self, songs):
+        self.texts = []
+        self.fields = []
+        self.popularity = array("q")
+        numbers = {}
+
+        for song in songs:
+            for field in SEARCH_FIELDS:
+                words = tokenize(song.get(field, ""))
+                if not words:
+                    continue
+
+                entry = (field, " ".join(words))
+                if entry not in numbers:
+                    numbers[entry] = len(self.texts)
+                    self.texts.append(str(song[field]))
+                    self.fields.append(field)
+                    self.popularity.append(0)
+                self.popularity[numbers[entry]] += song.get("popularity", 0)
+
+        suffixes = sorted(
+            (" ".join(words[start:]), number)
+            for (_, normalized), number in numbers.items()
+            for words in (normalized.split(" "),)
+            for start in range(len(words))
+        )
+        self.keys = [key for key, _ in suffixes]
+        self.key_entries = array("I", (number for _, number in suffixes))
+        self._short_prefixes = {}
+
+    @classmethod
+    def from_collection(cls, collection) -> "SuggestIndex":
+        """Builds the index from the artist, title and rating count of every song."""
+
+        # Songs rated before the running aggregates existed only have the array.
+        popularity = {
+            "$ifNull": ["$ratings_count", {"$size": {"$ifNull": ["$ratings", []]}}]
+        }
+        return cls(
+            collection.aggregate(
+                [
+                    {
+                        "$project": {
+                            **{field: 1 for field in SEARCH_FIELDS},
+                            "popularity": popularity,
+                        }
+                    }
+                ]
+            )
+        )
+
+    def suggest(self, prefix: str, limit: int = 10) -> list:
+        """
+        Returns the `limit` most popular entries completing `prefix`.
+
+        - Each suggestion is a dictionary with the "text", the "field" and the
+          "popularity" of the entry.
+        """
+
+        prefix = " ".join(tokenize(prefix))
+        if not prefix:
+            return []
+
+        if len(prefix) <= SHORT_PREFIX_LENGTH:
+            top = self._short_prefixes.get(prefix)
+            if top is None or len(top) < limit:
+                top = self._top(prefix, limit)
+                self._short_prefixes[prefix] = top
+            top = top[:limit]
+        else:
+            top = self._top(prefix, limit)
+
+        return [
+            {
+                "text": self.texts[number],
+                "field": self.fields[number],
+                "popularity": self.popularity[number],
+            }
+            for number in top
+        ]
+
+    def _top(self, prefix: str, limit: int) -> list:
+        start = bisect_left(self.keys, prefix)
+        end = bisect_left(self.keys, prefix + "\U0010ffff", start)
+
+        # An entry can match the prefix on several of its words.
+        numbers = set(self.key_entries[start:end])
+        # Ties keep the indexing order.
+        return heapq.nsmallest(
+            limit, numbers, key=lambda number: (-self.popularity[number], number)
+        )
+
+    def memory_usage(self) -> dict:
+        """Returns the number of entries and keys and the bytes used per entry."""
+
+        size = (
+            sys.getsizeof(self.texts)
+            + sum(sys.getsizeof(text) for text in self.texts)
+            + sys.getsizeof(self.fields)
+            + sys.getsizeof(self.keys)
+            + sum(sys.getsizeof(key) for key in self.keys)
+            + self.popularity.buffer_info()[1] * self.popularity.itemsize
+            + self.key_entries.buffer_info()[1] * self.key_entries.itemsize
+        )
+        return {
+            "entries": len(self),
+            "keys": len(self.keys),
+            "bytes": size,
+            "bytes_per_entry": round(size / len(self), 2) if len(self) else 0,
+        }
+
+    def __len__(self) -> int:
+        return len(self.texts)
@@ -1,12 +1,60 @@
+import asyncio
+import base64
+import gzip
+import importlib.util
 import json
+import os
+import tempfile
+import threading
+import time
+import types
 import unittest
+from unittest import mock
 
+from bson import json_util
 from bson.objectid import ObjectId
 from flask_pymongo import PyMongo
-from _pytest.monkeypatch import MonkeyPatch
+from pymongo import ASCENDING, DESCENDING
+from pymongo.read_preferences import Primary, Secondary, SecondaryPreferred
+from werkzeug.datastructures import Accept
 
 import main
-from import_data import add_data, delete_database
+from cache import (
+    Cache,
+    CacheNamespace,
+    Revalidator,
+    SharedCacheBackend,
+    SingleFlight,
+    start_shared_cache,
+)
+from compression import ENCODINGS, compress, negotiate
+from difficulty_index import DifficultyIndex
+from import_data import (
+    add_data,
+    add_data_parallel,
+    backfill_rating_aggregates,
+    delete_database,
+    invalidate_cache,
+    parse_song,
+    read_batches,
+    split_ranges,
+    sync_data,
+)
+from json_provider import JSONProvider, OrjsonProvider, get_provider
+from metrics import Counter, Histogram, Metrics
+from mongo import (
+    MongoConnection,
+    PoolStats,
+    client_options,
+    get_client,
+    read_preference,
+    settings_from_env,
+)
+from pagination import InvalidCursor, decode_cursor, encode_cursor, keyset_filter
+from ratings import add_rating
+from profiler import ProfilerBusy, SamplingProfiler
+from search_index import SearchIndex, within_one_edit
+from suggest_index import SuggestIndex
 
 
 class TestEmptyDB(unittest.TestCase):
@@ -291,6 +339,8 @@ class TestAPIs(unittest.TestCase):
         self.app.testing = True
         self.app.MONGO_URI = self.mongo_url
         add_data(self.mongo_url)
+        # Every test starts from a freshly loaded database, so start from a cold cache.
+        main.cache.clear()
         self.db = PyMongo(self.app).db
         self.client = self.app.test_client()
 
@@ -335,6 +385,116 @@ class TestAPIs(unittest.TestCase):
         self.assertIn("released", response.json["songs"][0])
         self.assertIn("title", response.json["songs"][0])
 
+    def walk_songs(self, url: str) -> list:
+        """Follows the next links from `url` and returns every song seen."""
+
+        songs = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            songs.extend(response.json["songs"])
+            url = response.json["_links"].get("next", {}).get("href")
+        return songs
+
+    def test_list_songs_route_with_limit(self):
+        response = self.client.get("/songs?limit=20")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json["songs"]), 11)
+        self.assertNotIn("next", response.json["_links"])
+
+        for limit in ("0", "101", "five"):
+            response = self.client.get(f"/songs?limit={limit}")
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(
+                response.json, {"error": "Please provide a 'limit' between 1 and 100."}
+            )
+
+    def test_list_songs_route_with_fields(self):
+        response = self.client.get("/songs?fields=title,artist&sort=difficulty")
+
+        self.assertEqual(response.status_code, 200)
+        for song in response.json["songs"]:
+            self.assertEqual(set(song), {"_id", "title", "artist"})
+
+        response = self.client.get("/songs?fields=title,secret")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json, {"error": "Invalid 'fields' value 'title,secret' provided."}
+        )
+
+    def test_list_songs_route_keyset_pagination(self):
+        songs = self.walk_songs("/songs?limit=3&sort=difficulty&fields=title")
+        self.assertEqual(len({song["_id"] for song in songs}), 11)
+        self.assertEqual(set(songs[0]), {"_id", "title"})
+
+        songs = self.walk_songs("/songs?limit=3&sort=difficulty")
+        difficulties = [song["difficulty"] for song in songs]
+        self.assertEqual(len({song["_id"] for song in songs}), 11)
+        self.assertEqual(difficulties, sorted(difficulties))
+
+        songs = self.walk_songs("/songs?limit=4&sort=-released")
+        released = [song["released"] for song in songs]
+        self.assertEqual(len({song["_id"] for song in songs}), 11)
+        self.assertEqual(released, sorted(released, reverse=True))
+
+        songs = self.walk_songs("/songs?limit=2")
+        ids = [song["_id"] for song in songs]
+        self.assertEqual(len(ids), 11)
+        self.assertEqual(ids, sorted(ids))
+
+    def test_list_songs_route_with_bad_sort_or_cursor(self):
+        response = self.client.get("/songs?sort=title")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json, {"error": "Invalid 'sort' value 'title' provided."}
+        )
+
+        # A plain id is not a valid cursor for a secondary sort key.
+        after_value = str(ObjectId())
+        response = self.client.get(f"/songs?sort=difficulty&after={after_value}")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json, {"error": f"Invalid 'after' value '{after_value}' provided."}
+        )
+
+    def test_export_songs_route(self):
+        response = self.client.get("/export/songs")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content_type, "application/x-ndjson")
+        self.assertTrue(response.is_streamed)
+
+        songs = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual(len(songs), 11)
+        self.assertEqual(
+            [song["_id"] for song in songs], sorted(s["_id"] for s in songs)
+        )
+        self.assertIn("title", songs[0])
+
+        # Resume the export after the fifth song with a projection.
+        response = self.client.get(
+            f"/export/songs?after={songs[4]['_id']}&fields=title"
+        )
+        resumed = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual(
+            resumed,
+            [{"_id": song["_id"], "title": song["title"]} for song in songs[5:]],
+        )
+
+    def test_export_songs_route_with_bad_parameters(self):
+        response = self.client.get("/export/songs?after=not_an_id")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json, {"error": "Invalid 'after' value 'not_an_id' provided."}
+        )
+
+        response = self.client.get("/export/songs?fields=,")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json, {"error": "Invalid 'fields' value ',' provided."}
+        )
+
     def test_list_average_difficulty_route_with_invalid_level(self):
         response = self.client.get("/average_difficulty?level=test")
 
@@ -406,6 +566,39 @@ class TestAPIs(unittest.TestCase):
             {"message": "No songs found to assess difficulty"},
         )
 
+    def test_list_average_difficulty_route_ignores_songs_without_difficulty(self):
+        self.db.songs.insert_one({"artist": "A new artist", "title": "No difficulty"})
+
+        response = self.client.get("/average_difficulty")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["average_difficulty"], 10.32)
+
+    def test_list_average_difficulty_route_serves_stale_histogram(self):
+        # An expired histogram is served while the real one is computed.
+        main.cache["difficulty"].set("histogram", DifficultyIndex([(27, 1)]), ttl=-1)
+
+        response = self.client.get("/average_difficulty")
+        self.assertEqual(response.json["average_difficulty"], 27)
+
+        # The refresh also changes the version of the cached response.
+        deadline = time.monotonic() + 5
+        while main.revalidator.stats()["pending"]:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+        self.assertIn("histogram", main.cache["difficulty"])
+        response = self.client.get("/average_difficulty")
+        self.assertEqual(response.json["average_difficulty"], 10.32)
+
+    def test_warm_up_builds_difficulty_index(self):
+        main.warm_up()
+
+        self.assertIn("histogram", main.cache["difficulty"])
+        self.assertEqual(
+            round(main.cache["difficulty"].get("histogram").average(), 2), 10.32
+        )
+
     def test_get_song_for_no_string_route(self):
         response = self.client.get("/songs/")
 
@@ -451,6 +644,312 @@ class TestAPIs(unittest.TestCase):
         self.assertIn("released", response.json["songs"][0])
         self.assertIn("title", response.json["songs"][0])
 
+    def test_get_song_matches_every_search_word(self):
+        response = self.client.get("/songs/the yousicians night")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [song["title"] for song in response.json["songs"]],
+            ["Wishing In The Night"],
+        )
+
+    def test_get_song_with_prefix_and_fuzzy_matching(self):
+        response = self.client.get("/songs/fastfing")
+        self.assertIn("message", response.json)
+
+        response = self.client.get("/songs/fastfing?prefix=true")
+        self.assertEqual(len(response.json["songs"]), 1)
+        self.assertEqual(response.json["songs"][0]["artist"], "Mr Fastfinger")
+
+        response = self.client.get("/songs/yousicans?fuzzy=true")
+        self.assertEqual(len(response.json["songs"]), 10)
+
+        # Every combination of options is cached on its own.
+        self.assertIn("fastfing|prefix", main.cache["search_words"])
+        self.assertIn("yousicans|fuzzy", main.cache["search_words"])
+
+    def test_get_song_pages_ranked_results(self):
+        response = self.client.get("/songs/the?limit=4")
+        self.assertEqual(response.status_code, 200)
+
+        # "The" is in the artist of every song of the Yousicians but also in
+        # some titles; all the matches weigh the same.
+        songs = response.json["songs"]
+        self.assertEqual(len(songs), 4)
+        self.assertNotIn("after", response.json["_links"]["self"]["href"])
+
+        titles = [song["title"] for song in songs]
+        while "next" in response.json["_links"]:
+            response = self.client.get(response.json["_links"]["next"]["href"])
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("limit=4", response.json["_links"]["self"]["href"])
+            titles.extend(song["title"] for song in response.json["songs"])
+
+        self.assertEqual(len(titles), 10)
+        self.assertEqual(len(set(titles)), 10)
+
+        # Only the ids are cached.
+        self.assertEqual(len(main.cache["search_words"].get("the")), 10)
+        self.assertIsInstance(main.cache["search_words"].get("the")[0], ObjectId)
+
+    def test_get_song_with_invalid_page_options(self):
+        response = self.client.get("/songs/the?limit=0")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json, {"error": "Please provide a 'limit' between 1 and 100."}
+        )
+
+        response = self.client.get(f"/songs/the?after={ObjectId()}")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("error", response.json)
+
+    def test_suggest_route(self):
+        song = self.db.songs.find_one({"title": "Wishing In The Night"})
+        self.client.put("/ratings", json={"song_id": str(song["_id"]), "rating": 4})
+        main.cache.clear()
+
+        response = self.client.get("/suggest?q=Wish")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json,
+            {
+                "suggestions": [
+                    {"text": "Wishing In The Night", "field": "title", "popularity": 1}
+                ]
+            },
+        )
+
+        # Rated entries come first; the artist is only suggested once.
+        response = self.client.get("/suggest?q=the&limit=3")
+        suggestions = response.json["suggestions"]
+        self.assertEqual(len(suggestions), 3)
+        self.assertEqual(suggestions[0]["text"], "The Yousicians")
+        self.assertEqual(suggestions[1]["text"], "Wishing In The Night")
+
+    def test_suggest_route_with_invalid_parameters(self):
+        response = self.client.get("/suggest")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, {"error": "Please provide a 'q' value."})
+
+        response = self.client.get("/suggest?q=the&limit=51")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json, {"error": "Please provide a 'limit' between 1 and 50."}
+        )
+
+    def test_cache_stats_route(self):
+        before = self.client.get("/cache_stats").json["namespaces"]["difficulty"]
+        self.client.get("/average_difficulty")
+        # The same request again is answered from the "responses" cache.
+        self.client.get("/average_difficulty?level=5")
+        response = self.client.get("/cache_stats")
+
+        self.assertEqual(response.status_code, 200)
+        after = response.json["namespaces"]["difficulty"]
+        self.assertEqual(after["hits"] - before["hits"], 1)
+        self.assertEqual(after["misses"] - before["misses"], 1)
+        self.assertIsInstance(response.json["coalesced"], dict)
+
+    def test_metrics_route(self):
+        self.client.get("/songs")
+        self.client.get("/average_difficulty")
+        self.client.get("/average_difficulty")
+        response = self.client.get("/metrics")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.content_type, "text/plain; version=0.0.4; charset=utf-8"
+        )
+        rendered = response.data.decode()
+        self.assertRegex(
+            rendered,
+            'artist_api_requests_total{route="/songs",method="GET",status="200"} \\d+',
+        )
+        self.assertIn(
+            'artist_api_request_duration_seconds_bucket{route="/average_difficulty",'
+            'method="GET",le="+Inf"}',
+            rendered,
+        )
+        self.assertIn('artist_api_response_size_bytes_count{route="/songs"}', rendered)
+        self.assertIn('artist_api_cache_hit_ratio{namespace="difficulty"}', rendered)
+
+    def test_profile_route(self):
+        # The route does not exist unless the profiler is enabled with a token.
+        response = self.client.post("/profile?seconds=0.05")
+        self.assertEqual(response.status_code, 404)
+
+        headers = {"Authorization": "Bearer secret"}
+        with mock.patch.dict(
+            main.app.config, {"PROFILER_ENABLED": True, "PROFILER_TOKEN": "secret"}
+        ):
+            response = self.client.post(
+                "/profile?seconds=0.05", headers={"Authorization": "Bearer guess"}
+            )
+            self.assertEqual(response.status_code, 401)
+
+            for query in ("seconds=60", "seconds=a", "route=/nowhere", "requests=0"):
+                response = self.client.post(f"/profile?{query}", headers=headers)
+                self.assertEqual(response.status_code, 400, query)
+
+            response = self.client.post("/profile?seconds=0.05", headers=headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, "text/plain")
+            for line in response.data.decode().splitlines():
+                self.assertRegex(line, r"^\S+ \d+$")
+
+    def test_pool_stats_route(self):
+        self.client.get("/songs")
+        response = self.client.get("/pool_stats")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["max_pool_size"], 100)
+        self.assertEqual(response.json["min_pool_size"], 0)
+        self.assertIsInstance(response.json["servers"], dict)
+
+    def test_read_preferences_per_endpoint(self):
+        read_preferences = {
+            "catalogue": "secondaryPreferred",
+            "difficulty": "secondary",
+            "ratings": "secondaryPreferred",
+        }
+        with mock.patch.dict(
+            main.app.config,
+            {
+                "MONGO_READ_PREFERENCES": read_preferences,
+                "MONGO_MAX_STALENESS_SECONDS": 120,
+            },
+        ), mock.patch.object(
+            main.db, "collection", wraps=main.db.collection
+        ) as collection:
+
+            def read_preferences_used(path):
+                collection.reset_mock()
+                self.client.get(path)
+                return [call.args[1] for call in collection.call_args_list]
+
+            self.assertEqual(
+                read_preferences_used("/songs"), [SecondaryPreferred(max_staleness=120)]
+            )
+            self.assertEqual(
+                read_preferences_used("/average_difficulty"),
+                [Secondary(max_staleness=120)],
+            )
+
+            song_id = str(self.db.songs.find_one()["_id"])
+            self.assertEqual(
+                read_preferences_used(f"/ratings/{song_id}"),
+                [SecondaryPreferred(max_staleness=120)],
+            )
+
+            # Right after a rating, the stats come from the primary, even once
+            # the cached stats are gone.
+            self.client.put("/ratings", json={"song_id": song_id, "rating": 4})
+            main.cache["ratings"].clear()
+            self.assertEqual(read_preferences_used(f"/ratings/{song_id}"), [Primary()])
+            self.assertEqual(
+                self.client.get(f"/ratings/{song_id}").json["average_rating"], 4
+            )
+
+    def test_conditional_get(self):
+        for path in ("/songs", "/average_difficulty"):
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers["Cache-Control"], "public, max-age=60")
+            etag = response.headers["ETag"]
+
+            with mock.patch.object(main.db, "collection") as collection:
+                response = self.client.get(path, headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b"")
+            self.assertEqual(response.headers["ETag"], etag)
+            collection.assert_not_called()
+
+        # An import changes the catalogue, so the lists are sent again.
+        invalidate_cache(main.cache, [])
+        response = self.client.get(path, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_conditional_get_caches_encoded_responses(self):
+        response = self.client.get("/songs?limit=3")
+        self.assertEqual(response.status_code, 200)
+
+        with mock.patch.object(
+            main.app.json_provider, "dumps"
+        ) as dumps, mock.patch.object(main.db, "collection") as collection:
+            cached = self.client.get("/songs?limit=3")
+        dumps.assert_not_called()
+        collection.assert_not_called()
+        self.assertEqual(cached.data, response.data)
+        self.assertEqual(cached.headers["ETag"], response.headers["ETag"])
+
+        # Other pages are other responses.
+        response = self.client.get("/songs?limit=2")
+        self.assertEqual(len(response.json["songs"]), 2)
+
+    def test_compressed_responses(self):
+        path = "/songs/yousicians?limit=20"
+        with mock.patch.dict(main.app.config, {"COMPRESSION_MIN_SIZE": 256}):
+            plain = self.client.get(path)
+            response = self.client.get(path, headers={"Accept-Encoding": "gzip"})
+            small = self.client.get(
+                "/songs/yousicians?limit=0", headers={"Accept-Encoding": "gzip"}
+            )
+
+        self.assertNotIn("Content-Encoding", plain.headers)
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(response.headers["Vary"], "Accept-Encoding")
+        self.assertEqual(int(response.headers["Content-Length"]), len(response.data))
+        self.assertLess(len(response.data), len(plain.data))
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+        # Errors are small and not worth compressing.
+        self.assertEqual(small.status_code, 400)
+        self.assertNotIn("Content-Encoding", small.headers)
+
+    def test_compressed_variants_are_cached(self):
+        headers = {"Accept-Encoding": "gzip"}
+        with mock.patch.dict(main.app.config, {"COMPRESSION_MIN_SIZE": 256}):
+            response = self.client.get("/songs", headers=headers)
+            with mock.patch("main.compress") as compress:
+                cached = self.client.get("/songs", headers=headers)
+
+        compress.assert_not_called()
+        self.assertEqual(cached.headers["Content-Encoding"], "gzip")
+        self.assertEqual(cached.data, response.data)
+
+    def test_conditional_get_after_rating(self):
+        song_id, other_id = (str(song["_id"]) for song in self.db.songs.find().limit(2))
+        for rated_id in (song_id, other_id):
+            self.client.put("/ratings", json={"song_id": rated_id, "rating": 2})
+
+        response = self.client.get(f"/ratings/{song_id.upper()}")
+        self.assertEqual(response.headers["Cache-Control"], "public, no-cache")
+        etag = response.headers["ETag"]
+        other_etag = self.client.get(f"/ratings/{other_id}").headers["ETag"]
+        songs_etag = self.client.get("/songs").headers["ETag"]
+
+        self.client.put("/ratings", json={"song_id": song_id, "rating": 4})
+
+        response = self.client.get(
+            f"/ratings/{song_id.upper()}", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["average_rating"], 3)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+        # The stats of other songs did not change, the song documents did.
+        response = self.client.get(
+            f"/ratings/{other_id}", headers={"If-None-Match": other_etag}
+        )
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get("/songs", headers={"If-None-Match": songs_etag})
+        self.assertEqual(response.status_code, 200)
+
+        # Errors are neither tagged nor cacheable.
+        response = self.client.get("/ratings/some_invalid_value")
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn("ETag", response.headers)
+
     def test_add_rating_to_song_route_with_no_song_id(self):
         response = self.client.put("/ratings", json={"no_song_id": "bad_song"})
 
@@ -705,6 +1204,177 @@ class TestAPIs(unittest.TestCase):
             },
         )
 
+    def test_add_rating_to_song_updates_cached_rating_stats(self):
+        song_id = str(ObjectId())
+        self.db.songs.insert_one(
+            {
+                "_id": ObjectId(song_id),
+                "artist": "A new artist",
+                "difficulty": 5,
+                "level": 5,
+                "released": "2021-01-01",
+                "title": "A new hit song",
+                "ratings": [2, 3],
+            }
+        )
+
+        # Warm up the cache for the song.
+        response = self.client.get(f"/ratings/{song_id}")
+        self.assertEqual(response.json["average_rating"], 2.5)
+        self.assertIn(song_id, main.cache["ratings"])
+
+        response = self.client.put("/ratings", json={"song_id": song_id, "rating": 5})
+        self.assertEqual(response.status_code, 204)
+
+        # The entry is updated in place rather than evicted.
+        self.assertIn(song_id, main.cache["ratings"])
+        hits = main.cache["ratings"].stats()["hits"]
+
+        response = self.client.get(f"/ratings/{song_id}")
+        self.assertEqual(
+            response.json,
+            {
+                "_id": song_id,
+                "average_rating": 3.33,
+                "highest_rating": 5,
+                "lowest_rating": 2,
+            },
+        )
+        self.assertEqual(main.cache["ratings"].stats()["hits"], hits + 1)
+
+    def test_add_rating_to_song_maintains_rating_aggregates(self):
+        song_id = self.db.songs.insert_one(
+            {"artist": "A new artist", "title": "A new hit song", "difficulty": 5}
+        ).inserted_id
+
+        for rating in (4, 2, 3):
+            response = self.client.put(
+                "/ratings", json={"song_id": str(song_id), "rating": rating}
+            )
+            self.assertEqual(response.status_code, 204)
+
+        song = self.db.songs.find_one({"_id": song_id})
+        self.assertEqual(song["ratings"], [4, 2, 3])
+        self.assertEqual(song["ratings_count"], 3)
+        self.assertEqual(song["ratings_sum"], 9)
+        self.assertEqual(song["ratings_min"], 2)
+        self.assertEqual(song["ratings_max"], 4)
+
+        response = self.client.get(f"/ratings/{song_id}")
+        self.assertEqual(
+            response.json,
+            {
+                "_id": str(song_id),
+                "average_rating": 3,
+                "highest_rating": 4,
+                "lowest_rating": 2,
+            },
+        )
+
+    def test_add_ratings_to_songs_bulk_route(self):
+        song_id = self.db.songs.insert_one({"title": "A new hit song"}).inserted_id
+        legacy_id = self.db.songs.insert_one({"ratings": [1]}).inserted_id
+        main.cache["ratings"].set(
+            str(song_id),
+            {"ratings_count": 1, "ratings_sum": 9, "ratings_min": 9, "ratings_max": 9},
+        )
+
+        response = self.client.post(
+            "/ratings/bulk",
+            json=[
+                {"song_id": str(song_id), "rating": 4},
+                {"song_id": "not_an_id", "rating": 4},
+                {"song_id": str(song_id), "rating": 2},
+                {"song_id": str(legacy_id), "rating": 5},
+                {"song_id": str(song_id), "rating": 6},
+                {"song_id": str(ObjectId()), "rating": 3},
+            ],
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json,
+            {
+                "applied": 4,
+                "errors": [
+                    {"index": 1, "error": "Invalid song_id 'not_an_id' provided."},
+                    {"index": 4, "error": "Please provide a rating between 1 and 5."},
+                ],
+            },
+        )
+
+        song = self.db.songs.find_one({"_id": song_id})
+        self.assertEqual(song["ratings"], [4, 2])
+        self.assertEqual((song["ratings_count"], song["ratings_sum"]), (2, 6))
+        self.assertEqual(self.db.songs.find_one({"_id": legacy_id})["ratings"], [1, 5])
+
+        # The stale cached aggregates were dropped.
+        self.assertNotIn(str(song_id), main.cache["ratings"])
+        response = self.client.get(f"/ratings/{song_id}")
+        self.assertEqual(response.json["average_rating"], 3)
+
+    def test_add_ratings_to_songs_bulk_route_with_ndjson(self):
+        song_id = str(self.db.songs.insert_one({"title": "A song"}).inserted_id)
+        lines = [
+            json.dumps({"song_id": song_id, "rating": 5}),
+            "{not json",
+            "",
+            json.dumps({"song_id": song_id}),
+        ]
+
+        response = self.client.post(
+            "/ratings/bulk",
+            data="\n".join(lines),
+            content_type="application/x-ndjson",
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json,
+            {
+                "applied": 1,
+                "errors": [
+                    {"index": 1, "error": "Please provide a song id."},
+                    {
+                        "index": 2,
+                        "error": "Please provide a rating value for the song.",
+                    },
+                ],
+            },
+        )
+
+    def test_add_ratings_to_songs_bulk_route_with_bad_body(self):
+        response = self.client.post("/ratings/bulk", json={"song_id": "a"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, {"error": "Please provide a list of ratings."})
+
+        items = [{"song_id": str(ObjectId()), "rating": 3}] * 1001
+        response = self.client.post("/ratings/bulk", json=items)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json, {"error": "Please provide at most 1000 ratings at once."}
+        )
+
+    def test_backfill_rating_aggregates(self):
+        rated_id = self.db.songs.insert_one({"ratings": [4, 1, 3]}).inserted_id
+        unrated_id = self.db.songs.insert_one({"ratings": []}).inserted_id
+
+        self.assertEqual(backfill_rating_aggregates(self.mongo_url), 2)
+        # Running the backfill again has nothing left to do.
+        self.assertEqual(backfill_rating_aggregates(self.mongo_url), 0)
+
+        rated = self.db.songs.find_one({"_id": rated_id})
+        self.assertEqual((rated["ratings_count"], rated["ratings_sum"]), (3, 8))
+        self.assertEqual((rated["ratings_min"], rated["ratings_max"]), (1, 4))
+
+        response = self.client.get(f"/ratings/{unrated_id}")
+        self.assertEqual(response.status_code, 404)
+
+        self.client.put("/ratings", json={"song_id": str(unrated_id), "rating": 5})
+        unrated = self.db.songs.find_one({"_id": unrated_id})
+        self.assertEqual(unrated["ratings_count"], 1)
+        self.assertEqual((unrated["ratings_min"], unrated["ratings_max"]), (5, 5))
+
     def tearDown(self):
         delete_database(self.mongo_url)
         del self.client
@@ -716,14 +1386,112 @@ class TestAPIs(unittest.TestCase):
 # ==================================================================================================
 
 
+@unittest.skipUnless(importlib.util.find_spec("motor"), "motor is not installed")
+class TestAsyncApp(unittest.TestCase):
+    """Checks that the ASGI app answers like the Flask app."""
+
+    def setUp(self):
+        import asgi
+
+        self.asgi = asgi
+        self.mongo_url = "mongodb://localhost:27017/test_db"
+        add_data(self.mongo_url)
+        main.cache.clear()
+        self.client = main.app.test_client()
+        self.loop = asyncio.new_event_loop()
+
+    def asgi_request(self, method: str, path: str, json_body=None) -> tuple:
+        """Runs a request through the ASGI app; returns the status and the body."""
+
+        path, _, query = path.partition("?")
+        body = b"" if json_body is None else json.dumps(json_body).encode()
+        scope = {
+            "type": "http",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "query_string": query.encode(),
+            "headers": [
+                (b"host", b"localhost"),
+                (b"content-type", b"application/json"),
+            ],
+            "server": ("localhost", 80),
+        }
+        messages = [{"type": "http.request", "body": body}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        self.loop.run_until_complete(self.asgi.app(scope, receive, send))
+        headers = dict(sent[0]["headers"])
+        response_body = sent[1]["body"]
+        if response_body and headers[b"content-type"] == b"application/json":
+            response_body = json.loads(response_body)
+        return sent[0]["status"], response_body or None
+
+    def assertSameResponse(self, path: str):
+        # Clear the cache in between so that both apps query the database.
+        main.cache.clear()
+        response = self.client.get(path)
+        main.cache.clear()
+        status, body = self.asgi_request("GET", path)
+
+        self.assertEqual(status, response.status_code, path)
+        self.assertEqual(body, response.json, path)
+
+    def test_async_app_parity(self):
+        song_id = str(self.client.get("/songs").json["songs"][0]["_id"])
+        self.assertEqual(
+            self.asgi_request("PUT", "/ratings", {"song_id": song_id, "rating": 4}),
+            (204, None),
+        )
+
+        for path in (
+            "/songs",
+            "/songs?limit=3&sort=-difficulty&fields=title",
+            "/songs?after=some_invalid_value",
+            "/average_difficulty",
+            "/average_difficulty?level=10",
+            "/average_difficulty?level=ten",
+            "/songs/yousicians?limit=4",
+            "/songs/fastfing?prefix=true",
+            "/songs/fake_word",
+            f"/ratings/{song_id}",
+            f"/ratings/{ObjectId()}",
+            "/ratings/invalid",
+        ):
+            self.assertSameResponse(path)
+
+        # Follow the next links of both apps.
+        next_page = self.client.get("/songs?limit=4").json["_links"]["next"]["href"]
+        self.assertSameResponse(next_page.replace("http://localhost", ""))
+
+    def test_async_app_errors(self):
+        self.assertEqual(
+            self.asgi_request("PUT", "/ratings", {"rating": 4}),
+            (400, {"error": "Please provide a song id."}),
+        )
+        self.assertEqual(self.asgi_request("GET", "/songs/")[0], 404)
+        self.assertEqual(self.asgi_request("PUT", "/songs")[0], 405)
+
+    def tearDown(self):
+        self.loop.close()
+        delete_database(self.mongo_url)
+
+
+# ==================================================================================================
+# ==================================================================================================
+# ==================================================================================================
+
+
 class TestCacheAPI(unittest.TestCase):
     """Tests runs to check if data is fetched from the cache"""
 
     def setUp(self) -> None:
-        # create a monkey patch instance for testing
-        self.monkeypatch = MonkeyPatch()
-        self.cache_copy = main.cache.copy()
-
         self.app = main.app
         self.app.testing = True
         self.app.MONGO_URI = "mongodb://localhost:27017/test_db"
@@ -731,8 +1499,10 @@ class TestCacheAPI(unittest.TestCase):
         self.client = self.app.test_client()
 
     def test_cached_average_difficulty_level(self):
-        # monkey patch the cache for the test case
-        self.monkeypatch.setitem(main.cache, "difficulty", {"base": 13.4, 23: 42})
+        # seed the cache for the test case
+        main.cache["difficulty"].set(
+            "histogram", DifficultyIndex([(1, 1), (23, 2), (61, 1)])
+        )
 
         response = self.client.get("/average_difficulty")
         self.assertEqual(response.status, "200 OK")
@@ -743,7 +1513,7 @@ class TestCacheAPI(unittest.TestCase):
         self.assertIn("average_difficulty", response.json)
         self.assertEqual(
             response.json,
-            {"difficulty_level": "All levels", "average_difficulty": 13.4},
+            {"difficulty_level": "All levels", "average_difficulty": 27},
         )
 
         response = self.client.get("/average_difficulty?level=23")
@@ -755,27 +1525,16 @@ class TestCacheAPI(unittest.TestCase):
         self.assertIn("average_difficulty", response.json)
         self.assertEqual(
             response.json,
-            {"difficulty_level": "Level 23 and above", "average_difficulty": 42},
+            {"difficulty_level": "Level 23 and above", "average_difficulty": 35.67},
         )
 
     def test_cache_get_song_for_search_word(self):
-        # monkey patch the cache for the test case
-        self.monkeypatch.setitem(
-            main.cache,
-            "search_words",
-            {
-                "test_1": [
-                    {
-                        "_id": 1,
-                        "artist": 2,
-                        "difficulty": 3,
-                        "level": 4,
-                        "released": 5,
-                        "title": "song",
-                    }
-                ]
-            },
-        )
+        song = {"artist": "Cached", "title": "Song", "difficulty": 3, "level": 4}
+        song_id = main.db.songs.insert_one(song).inserted_id
+        self.addCleanup(main.db.songs.delete_one, {"_id": song_id})
+
+        # seed the cache for the test case; only the ids of the matches are cached
+        main.cache["search_words"].set("test_1", [song_id])
 
         response = self.client.get("/songs/Test_1")
         self.assertEqual(response.status, "200 OK")
@@ -784,41 +1543,30 @@ class TestCacheAPI(unittest.TestCase):
         self.assertIsInstance(response.json, dict)
         self.assertIn("songs", response.json)
         self.assertEqual(
-            response.json,
-            {
-                "songs": [
-                    {
-                        "_id": 1,
-                        "artist": 2,
-                        "difficulty": 3,
-                        "level": 4,
-                        "released": 5,
-                        "title": "song",
-                    }
-                ]
-            },
+            response.json["songs"],
+            [
+                {
+                    "_id": str(song_id),
+                    "artist": "Cached",
+                    "title": "Song",
+                    "difficulty": 3,
+                    "level": 4,
+                }
+            ],
         )
 
     def test_cache_list_song_rating_stats(self):
 
         song_id_1, song_id_2 = str(ObjectId()), str(ObjectId())
 
-        # monkey patch the cache for the test case
-        self.monkeypatch.setitem(
-            main.cache,
-            "ratings",
-            {
-                song_id_1: {
-                    "average_rating": 1.5,
-                    "lowest_rating": 1,
-                    "highest_rating": 2,
-                },
-                song_id_2: {
-                    "average_rating": 2,
-                    "lowest_rating": 1,
-                    "highest_rating": 3,
-                },
-            },
+        # seed the cache for the test case
+        main.cache["ratings"].set(
+            song_id_1,
+            {"ratings_count": 2, "ratings_sum": 3, "ratings_min": 1, "ratings_max": 2},
+        )
+        main.cache["ratings"].set(
+            song_id_2,
+            {"ratings_count": 3, "ratings_sum": 6, "ratings_min": 1, "ratings_max": 3},
         )
 
         response = self.client.get(f"/ratings/{song_id_1}")
@@ -861,9 +1609,838 @@ class TestCacheAPI(unittest.TestCase):
 
     def tearDown(self) -> None:
 
-        main.cache = self.cache_copy
+        main.cache.clear()
 
-        del self.cache_copy
-        del self.monkeypatch
         del self.client
         del self.app
+
+
+# ==================================================================================================
+# ==================================================================================================
+# ==================================================================================================
+
+
+class FakeClock:
+    """A manually advanced clock to test time based cache expiry."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCache(unittest.TestCase):
+    """Tests for the bounded TTL/LRU cache."""
+
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+
+    def test_cache_namespace_lru_eviction(self):
+        namespace = CacheNamespace(max_size=2, clock=self.clock)
+        namespace.set("a", 1)
+        namespace.set("b", 2)
+
+        # Touch "a" so that "b" becomes the least recently used entry.
+        self.assertEqual(namespace.get("a"), 1)
+        namespace.set("c", 3)
+
+        self.assertIn("a", namespace)
+        self.assertNotIn("b", namespace)
+        self.assertIn("c", namespace)
+        self.assertEqual(len(namespace), 2)
+        self.assertEqual(namespace.stats()["evictions"], 1)
+
+    def test_cache_namespace_ttl_expiry(self):
+        namespace = CacheNamespace(max_size=2, ttl=10, clock=self.clock)
+        namespace.set("a", 1)
+        namespace.set("b", 2, ttl=30)
+
+        self.clock.now = 10
+        self.assertIsNone(namespace.get("a"))
+        self.assertEqual(namespace.get("b"), 2)
+
+        self.clock.now = 30
+        self.assertEqual(namespace.get("b", "missing"), "missing")
+
+        stats = namespace.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["expirations"], 2)
+        self.assertEqual(stats["size"], 0)
+
+    def test_cache_namespace_stale_entries(self):
+        namespace = CacheNamespace(max_size=2, ttl=10, max_stale=5, clock=self.clock)
+        namespace.set("a", 1)
+        self.assertEqual(namespace.get_stale("a"), (1, True))
+
+        # Expired entries are only served by `get_stale`, and can be updated.
+        self.clock.now = 12
+        self.assertIsNone(namespace.get("a"))
+        self.assertNotIn("a", namespace)
+        self.assertTrue(namespace.update("a", lambda value: value + 1))
+        self.assertEqual(namespace.get_stale("a"), (2, False))
+
+        self.clock.now = 15
+        self.assertEqual(namespace.get_stale("a", "missing"), ("missing", False))
+        self.assertFalse(namespace.update("a", lambda value: value + 1))
+
+        stats = namespace.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["stale_hits"], 1)
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["expirations"], 1)
+
+    def test_cache_namespace_update(self):
+        namespace = CacheNamespace(max_size=2, ttl=10, clock=self.clock)
+        namespace.set("a", 1)
+
+        self.assertTrue(namespace.update("a", lambda value: value + 1))
+        self.assertFalse(namespace.update("b", lambda value: value + 1))
+        self.assertEqual(namespace.get("a"), 2)
+        self.assertNotIn("b", namespace)
+
+        # Updates neither revive nor extend expired entries.
+        self.clock.now = 10
+        self.assertFalse(namespace.update("a", lambda value: value + 1))
+
+    def test_cache_namespace_disabled(self):
+        namespace = CacheNamespace(max_size=0)
+        namespace.set("a", 1)
+
+        self.assertIsNone(namespace.get("a"))
+        self.assertEqual(len(namespace), 0)
+
+    def test_cache_from_config(self):
+        cache = Cache.from_config(
+            {
+                "CACHE_DEFAULT_MAX_SIZE": 10,
+                "CACHE_DEFAULT_TTL": 5,
+                "CACHE_NAMESPACES": {"ratings": {"ttl": 60}, "difficulty": {}},
+            }
+        )
+
+        self.assertEqual(cache["ratings"].max_size, 10)
+        self.assertEqual(cache["ratings"].ttl, 60)
+        self.assertEqual(cache["difficulty"].ttl, 5)
+        self.assertEqual(set(cache.stats()), {"ratings", "difficulty"})
+
+
+class TestSingleFlight(unittest.TestCase):
+    """Tests for the coalescing of concurrent cache misses."""
+
+    def setUp(self) -> None:
+        self.single_flight = SingleFlight()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def compute(self, value):
+        self.calls += 1
+        self.release.wait(5)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def run_concurrently(self, value, followers: int = 4) -> list:
+        results = []
+
+        def call():
+            try:
+                results.append(self.single_flight.do("ns", "key", self.compute, value))
+            except Exception as error:
+                results.append(error)
+
+        threads = [threading.Thread(target=call) for _ in range(followers + 1)]
+        for thread in threads:
+            thread.start()
+        # Release the computation once every other call waits for it.
+        deadline = time.monotonic() + 5
+        while self.single_flight.stats().get("ns", 0) < followers:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.001)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_single_flight_coalesces_concurrent_calls(self):
+        results = self.run_concurrently([1, 2])
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [[1, 2]] * 5)
+        self.assertEqual(self.single_flight.stats(), {"ns": 4})
+
+        # Later calls compute again.
+        self.assertEqual(self.single_flight.do("ns", "key", self.compute, 3), 3)
+        self.assertEqual(self.calls, 2)
+
+    def test_single_flight_shares_errors(self):
+        error = ValueError("no database")
+        results = self.run_concurrently(error, followers=2)
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [error] * 3)
+
+
+class TestRevalidator(unittest.TestCase):
+    """Tests for the background refresh of stale cache entries."""
+
+    def test_revalidator_refreshes_each_entry_once_at_a_time(self):
+        revalidator = Revalidator(max_workers=2)
+        release = threading.Event()
+        refreshed = []
+
+        def refresh(value):
+            release.wait(5)
+            refreshed.append(value)
+
+        self.assertTrue(revalidator.refresh("ns", "key", refresh, 1))
+        self.assertFalse(revalidator.refresh("ns", "key", refresh, 2))
+        self.assertTrue(revalidator.refresh("ns", "other", refresh, 3))
+        self.assertEqual(revalidator.stats()["pending"], 2)
+
+        release.set()
+        revalidator._executor.shutdown(wait=True)
+
+        self.assertEqual(sorted(refreshed), [1, 3])
+        self.assertEqual(
+            revalidator.stats(), {"pending": 0, "refreshes": 2, "failures": 0}
+        )
+
+    def test_revalidator_counts_failures(self):
+        revalidator = Revalidator()
+
+        def fail():
+            raise ValueError("no database")
+
+        with self.assertLogs("cache", level="ERROR"):
+            revalidator.refresh("ns", "key", fail)
+            revalidator._executor.shutdown(wait=True)
+
+        self.assertEqual(revalidator.stats()["failures"], 1)
+
+
+class TestSharedCache(unittest.TestCase):
+    """Tests for the cache shared between processes over a local socket."""
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.address = os.path.join(self.tmp_dir.name, "cache.sock")
+        self.server = start_shared_cache(self.address, b"secret")
+
+        # Two caches stand in for two gunicorn workers of the same host.
+        namespaces = {"ratings": {"max_size": 2, "ttl": 60}}
+        self.worker_1 = Cache(
+            namespaces, backend=SharedCacheBackend(self.address, b"secret")
+        )
+        self.worker_2 = Cache(
+            namespaces, backend=SharedCacheBackend(self.address, b"secret")
+        )
+
+    def test_shared_cache_is_visible_to_all_workers(self):
+        aggregates = {
+            "ratings_count": 1,
+            "ratings_sum": 4,
+            "ratings_min": 4,
+            "ratings_max": 4,
+        }
+        self.worker_1["ratings"].set("song", aggregates)
+
+        self.assertIn("song", self.worker_2["ratings"])
+        self.assertEqual(self.worker_2["ratings"].get("song"), aggregates)
+
+        self.assertTrue(self.worker_2["ratings"].update("song", add_rating, 2))
+        self.assertEqual(self.worker_1["ratings"].get("song")["ratings_count"], 2)
+
+        self.worker_1["ratings"].delete("song")
+        self.assertIsNone(self.worker_2["ratings"].get("song"))
+
+    def test_shared_cache_bounds_and_stats(self):
+        for key in ("a", "b", "c"):
+            self.worker_1["ratings"].set(key, key)
+
+        self.assertEqual(len(self.worker_2["ratings"]), 2)
+        self.assertNotIn("a", self.worker_2["ratings"])
+
+        stats = self.worker_2.stats()["ratings"]
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["max_size"], 2)
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.tmp_dir.cleanup()
+
+
+class TestDifficultyIndex(unittest.TestCase):
+    """Tests for the difficulty histogram with prefix sums."""
+
+    def setUp(self) -> None:
+        self.index = DifficultyIndex([(2.5, 2), (4, 1), (9, 3)])
+
+    def test_difficulty_index_totals(self):
+        self.assertEqual(len(self.index), 6)
+        self.assertEqual(self.index.totals(), (6, 36))
+        # Levels between two values, on a value, and around both ends.
+        self.assertEqual(self.index.totals(3), (4, 31))
+        self.assertEqual(self.index.totals(4), (4, 31))
+        self.assertEqual(self.index.totals(0), (6, 36))
+        self.assertEqual(self.index.totals(9.5), (0, 0))
+
+    def test_difficulty_index_average(self):
+        self.assertEqual(self.index.average(), 6)
+        self.assertEqual(self.index.average(5), 9)
+        self.assertIsNone(self.index.average(10))
+        self.assertIsNone(DifficultyIndex([]).average())
+
+
+class TestSearchIndex(unittest.TestCase):
+    """Tests for the inverted index of the song words."""
+
+    def setUp(self) -> None:
+        self.ids = [ObjectId() for _ in range(3)]
+        self.index = SearchIndex()
+        self.index.add(
+            {"_id": self.ids[0], "artist": "Mr Fastfinger", "title": "Awaki"}
+        )
+        self.index.add(
+            {"_id": self.ids[1], "artist": "The Yousicians", "title": "Night"}
+        )
+        self.index.add({"_id": self.ids[2], "artist": "The Yousicians", "title": "Day"})
+
+    def test_search_index_and_query(self):
+        self.assertEqual(self.index.search("YOUSICIANS"), self.ids[1:])
+        self.assertEqual(self.index.search("the yousicians day"), [self.ids[2]])
+        self.assertEqual(self.index.search("yousicians awaki"), [])
+        self.assertEqual(self.index.search("!!"), [])
+
+    def test_search_index_prefix_and_fuzzy(self):
+        self.assertEqual(self.index.search("fast"), [])
+        self.assertEqual(self.index.search("fast", prefix=True), [self.ids[0]])
+        self.assertEqual(self.index.search("nihgt the", fuzzy=True), [])
+        self.assertEqual(self.index.search("nigt the", fuzzy=True), [self.ids[1]])
+        self.assertEqual(self.index.search("dya", fuzzy=True, prefix=True), [])
+
+    def test_search_index_ranking(self):
+        nights_id = ObjectId()
+        self.index.add({"_id": nights_id, "artist": "The Nights", "title": "Day"})
+
+        # Exact matches outweigh fuzzy ones; ties keep the indexing order.
+        self.assertEqual(
+            self.index.search("night", fuzzy=True), [self.ids[1], nights_id]
+        )
+        self.assertEqual(
+            self.index.search("the nights", fuzzy=True), [nights_id, self.ids[1]]
+        )
+        self.assertEqual(self.index.search("the", limit=2), self.ids[1:])
+
+    def test_search_index_replaces_songs(self):
+        self.index.add(
+            {"_id": self.ids[1], "artist": "The Yousicians", "title": "Noon"}
+        )
+
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.index.search("night"), [])
+        self.assertEqual(self.index.search("noon"), [self.ids[1]])
+
+    def test_within_one_edit(self):
+        self.assertTrue(within_one_edit("night", "night"))
+        self.assertTrue(within_one_edit("night", "nigt"))
+        self.assertTrue(within_one_edit("night", "nights"))
+        self.assertTrue(within_one_edit("night", "light"))
+        self.assertFalse(within_one_edit("night", "nihgt"))
+        self.assertFalse(within_one_edit("night", "day"))
+
+
+class TestSuggestIndex(unittest.TestCase):
+    """Tests for the prefix index of the artists and titles."""
+
+    def setUp(self) -> None:
+        self.index = SuggestIndex(
+            [
+                {"artist": "The Yousicians", "title": "A New Kennel", "popularity": 1},
+                {"artist": "The Yousicians", "title": "Night", "popularity": 2},
+                {"artist": "Mr Fastfinger", "title": "Awaki-Waki", "popularity": 5},
+            ]
+        )
+
+    def test_suggest_ranks_by_popularity(self):
+        self.assertEqual(len(self.index), 5)
+        self.assertEqual(
+            self.index.suggest("  THE you"),
+            [{"text": "The Yousicians", "field": "artist", "popularity": 3}],
+        )
+        self.assertEqual(
+            [suggestion["text"] for suggestion in self.index.suggest("a")],
+            ["Awaki-Waki", "A New Kennel"],
+        )
+        self.assertEqual(
+            [suggestion["text"] for suggestion in self.index.suggest("n", limit=1)],
+            ["Night"],
+        )
+        # Short prefixes are remembered, whatever the limit.
+        self.assertEqual(len(self.index.suggest("n")), 2)
+        self.assertEqual(self.index.suggest("zz"), [])
+        self.assertEqual(self.index.suggest("!"), [])
+
+    def test_suggest_matches_every_word(self):
+        self.assertEqual(
+            [suggestion["text"] for suggestion in self.index.suggest("waki")],
+            ["Awaki-Waki"],
+        )
+        self.assertEqual(
+            [suggestion["text"] for suggestion in self.index.suggest("new ke")],
+            ["A New Kennel"],
+        )
+
+    def test_suggest_memory_usage(self):
+        usage = self.index.memory_usage()
+
+        self.assertEqual(usage["entries"], 5)
+        # Every word of every entry starts a key.
+        self.assertEqual(usage["keys"], 10)
+        self.assertGreater(usage["bytes_per_entry"], 0)
+        self.assertEqual(SuggestIndex([]).memory_usage()["bytes_per_entry"], 0)
+
+
+class TestMongoConnection(unittest.TestCase):
+    """Tests for the client settings and the shared client of a process."""
+
+    def test_client_settings(self):
+        settings = settings_from_env(
+            {"MONGO_MAX_POOL_SIZE": "20", "MONGO_COMPRESSORS": "zlib", "HOME": "/"}
+        )
+        self.assertEqual(
+            settings, {"MONGO_MAX_POOL_SIZE": 20, "MONGO_COMPRESSORS": "zlib"}
+        )
+
+        config = {**settings, "MONGO_MIN_POOL_SIZE": None, "MONGO_URI": "unused"}
+        self.assertEqual(
+            client_options(config), {"maxPoolSize": 20, "compressors": "zlib"}
+        )
+
+    def test_connection_is_created_once_per_process(self):
+        connection = MongoConnection("mongodb://localhost:27017/test_db", maxPoolSize=5)
+        self.assertIsNone(connection._client)
+
+        self.assertIs(connection.client, connection.client)
+        self.assertEqual(connection.songs.name, "songs")
+        self.assertEqual(connection.stats()["max_pool_size"], 5)
+
+        url = "mongodb://localhost:27017/test_db"
+        self.assertIs(get_client(url), get_client(url))
+        self.assertIsNot(get_client(url), get_client(url, maxPoolSize=1))
+
+    def test_read_preference(self):
+        self.assertEqual(read_preference("primary", 120), Primary())
+        self.assertEqual(
+            read_preference("secondary", 120), Secondary(max_staleness=120)
+        )
+        self.assertEqual(read_preference("secondaryPreferred").max_staleness, -1)
+        with self.assertRaises(ValueError):
+            read_preference("secondaries")
+
+    def test_pool_stats(self):
+        stats = PoolStats()
+        event = types.SimpleNamespace(address=("localhost", 27017))
+
+        stats.pool_created(event)
+        stats.connection_created(event)
+        for _ in range(2):
+            stats.connection_check_out_started(event)
+        stats.connection_checked_out(event)
+        stats.connection_check_out_failed(event)
+        stats.connection_check_out_started(event)
+
+        self.assertEqual(
+            stats.snapshot(),
+            {
+                "localhost:27017": {
+                    "open": 1,
+                    "in_use": 1,
+                    "waiting": 1,
+                    "checkouts": 1,
+                    "checkout_failures": 1,
+                }
+            },
+        )
+
+        stats.connection_checked_in(event)
+        stats.connection_closed(event)
+        self.assertEqual(stats.snapshot()["localhost:27017"]["open"], 0)
+        self.assertEqual(stats.snapshot()["localhost:27017"]["in_use"], 0)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram(self):
+        histogram = Histogram("latency", "Latency.", ("route",), (0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(("/songs",), value)
+
+        self.assertEqual(
+            histogram.render(),
+            [
+                "# HELP latency Latency.",
+                "# TYPE latency histogram",
+                'latency_bucket{route="/songs",le="0.1"} 2',
+                'latency_bucket{route="/songs",le="1"} 3',
+                'latency_bucket{route="/songs",le="+Inf"} 4',
+                'latency_sum{route="/songs"} 3.65',
+                'latency_count{route="/songs"} 4',
+            ],
+        )
+
+    def test_label_values_are_escaped(self):
+        counter = Counter("requests", "Requests.", ("route",))
+        counter.inc(('/say "hi"\\n',))
+        self.assertEqual(counter.render()[-1], 'requests{route="/say \\"hi\\"\\\\n"} 1')
+
+    def test_command_timer(self):
+        metrics = Metrics()
+        listener = metrics.command_listener()
+        event = types.SimpleNamespace(command_name="find", duration_micros=1500)
+
+        listener.started(event)
+        listener.succeeded(event)
+        listener.failed(event)
+
+        rendered = metrics.render()
+        self.assertIn(
+            'artist_api_mongodb_command_duration_seconds_count{command="find"} 2',
+            rendered,
+        )
+        self.assertIn(
+            'artist_api_mongodb_command_failures_total{command="find"} 1', rendered
+        )
+
+
+def spin(stop: threading.Event):
+    while not stop.is_set():
+        sum(range(100))
+
+
+def other_spin(stop: threading.Event):
+    spin(stop)
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self) -> None:
+        self.profiler = SamplingProfiler()
+        self.stop = threading.Event()
+
+    def start(self, target):
+        thread = threading.Thread(target=target, args=(self.stop,))
+        thread.start()
+        # Cleanups run last in first out: stop the thread, then wait for it.
+        self.addCleanup(thread.join)
+        self.addCleanup(self.stop.set)
+
+    def test_capture_every_thread(self):
+        self.start(spin)
+
+        samples = self.profiler.capture(0.1, 0.005)
+
+        self.assertFalse(self.profiler.active)
+        self.assertTrue(
+            any(stack.endswith("test_project.py:spin") for stack in samples)
+        )
+
+    def test_capture_requests_of_a_route(self):
+        def request(stop):
+            while not self.profiler.active:
+                time.sleep(0.001)
+            self.profiler.request_started("/songs")
+            deadline = time.monotonic() + 0.1
+            while time.monotonic() < deadline:
+                sum(range(100))
+            self.profiler.request_finished()
+
+        self.start(other_spin)
+        self.start(request)
+
+        started = time.monotonic()
+        samples = self.profiler.capture(5, 0.005, route="/songs", requests=1)
+
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertTrue(samples)
+        self.assertTrue(all(":request" in stack for stack in samples))
+
+    def test_one_capture_at_a_time(self):
+        capture = threading.Thread(target=self.profiler.capture, args=(0.2, 0.01))
+        capture.start()
+        self.addCleanup(capture.join)
+        while not self.profiler.active:
+            time.sleep(0.001)
+
+        with self.assertRaises(ProfilerBusy):
+            self.profiler.capture(0.1, 0.01)
+
+
+class TestCompression(unittest.TestCase):
+    def test_negotiate(self):
+        gzip_preferred = Accept([("gzip", 1), ("br", 0.5)])
+
+        self.assertEqual(negotiate(gzip_preferred, 2048, 1024), "gzip")
+        self.assertIsNone(negotiate(gzip_preferred, 1023, 1024))
+        self.assertIsNone(negotiate(Accept([("identity", 1)]), 2048, 1024))
+        self.assertIsNone(negotiate(Accept([("gzip", 0)]), 2048, 1024))
+        self.assertEqual(negotiate(Accept([("*", 1)]), 2048, 1024), ENCODINGS[0])
+
+    def test_compress(self):
+        data = b'{"artist":"The Yousicians"}' * 100
+
+        compressed = compress(data, "gzip", 6)
+        self.assertEqual(gzip.decompress(compressed), data)
+        self.assertLess(len(compressed), len(data) // 10)
+        # The same body always compresses to the same bytes.
+        self.assertEqual(compress(data, "gzip", 6), compressed)
+        with self.assertRaises(ValueError):
+            compress(data, "compress", 6)
+
+    @unittest.skipUnless(importlib.util.find_spec("brotli"), "brotli is not installed")
+    def test_compress_brotli(self):
+        import brotli
+
+        data = b'{"artist":"The Yousicians"}' * 100
+        self.assertEqual(brotli.decompress(compress(data, "br", 4)), data)
+        self.assertEqual(negotiate(Accept([("gzip", 1), ("br", 1)]), 2048, 0), "br")
+
+
+class TestJSONProvider(unittest.TestCase):
+    def setUp(self) -> None:
+        self.song = {
+            "title": "Lycanthropic Metamorphosis",
+            "_id": ObjectId("60f6a1f1e13cf2bf5c9bbd63"),
+            "artist": "Mötörhead",
+            "ratings": [4, 5],
+        }
+
+    def test_encodes_object_ids_without_changing_the_document(self):
+        provider = JSONProvider(sort_keys=True)
+
+        self.assertEqual(
+            provider.dumps(self.song),
+            '{"_id":"60f6a1f1e13cf2bf5c9bbd63","artist":"Mötörhead",'
+            '"ratings":[4,5],"title":"Lycanthropic Metamorphosis"}'.encode(),
+        )
+        self.assertIsInstance(self.song["_id"], ObjectId)
+        with self.assertRaises(TypeError):
+            provider.dumps({"at": object()})
+
+    @unittest.skipUnless(importlib.util.find_spec("orjson"), "orjson is not installed")
+    def test_orjson_encodes_like_json(self):
+        for sort_keys in (False, True):
+            self.assertEqual(
+                OrjsonProvider(sort_keys).dumps(self.song),
+                JSONProvider(sort_keys).dumps(self.song),
+            )
+        self.assertEqual(OrjsonProvider().loads(b'{"a":[1]}'), {"a": [1]})
+        self.assertIsInstance(get_provider(), OrjsonProvider)
+
+    def test_get_provider(self):
+        self.assertIsInstance(get_provider("json"), JSONProvider)
+        self.assertTrue(get_provider("json", sort_keys=True).sort_keys)
+        with self.assertRaises(ValueError):
+            get_provider("simplejson")
+
+
+class TestPagination(unittest.TestCase):
+    """Tests for the keyset pagination helpers."""
+
+    def test_cursor_round_trip(self):
+        song = {"_id": ObjectId(), "difficulty": 13.22}
+
+        cursor = encode_cursor("difficulty", song)
+        self.assertEqual(decode_cursor("difficulty", cursor), (13.22, song["_id"]))
+        self.assertEqual(encode_cursor("_id", song), str(song["_id"]))
+
+        # Cursors are only valid for the sort key they were built for.
+        with self.assertRaises(InvalidCursor):
+            decode_cursor("released", cursor)
+
+    def test_cursor_rejects_query_operators(self):
+        payload = json_util.dumps(["difficulty", {"$ne": None}, ObjectId()])
+        cursor = base64.urlsafe_b64encode(payload.encode()).decode()
+
+        with self.assertRaises(InvalidCursor):
+            decode_cursor("difficulty", cursor)
+
+    def test_keyset_filter(self):
+        song_id = ObjectId()
+
+        self.assertEqual(
+            keyset_filter("_id", DESCENDING, None, song_id), {"_id": {"$lt": song_id}}
+        )
+        self.assertEqual(
+            keyset_filter("difficulty", ASCENDING, 5, song_id),
+            {
+                "$or": [
+                    {"difficulty": {"$gt": 5}},
+                    {"difficulty": 5, "_id": {"$gt": song_id}},
+                ]
+            },
+        )
+        self.assertEqual(
+            keyset_filter("difficulty", DESCENDING, None, song_id),
+            {"difficulty": None, "_id": {"$lt": song_id}},
+        )
+
+
+class TestImportData(unittest.TestCase):
+    """Tests for the streaming importer."""
+
+    def setUp(self) -> None:
+        self.mongo_url = "mongodb://localhost:27017/test_db"
+        self.db = PyMongo(main.app).db
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "songs.json")
+        self.checkpoint = os.path.join(self.tmp_dir.name, "songs.checkpoint")
+
+        with open(self.path, "w") as file:
+            for number in range(7):
+                file.write(json.dumps({"title": f"Song {number}"}) + "\n")
+            # Blank lines are skipped.
+            file.write("\n")
+
+    def test_read_batches(self):
+        with open(self.path, "rb") as file:
+            batches = list(read_batches(file, 3))
+
+        self.assertEqual([len(songs) for songs, _ in batches], [3, 3, 1])
+        # Every offset points at the start of the next line.
+        with open(self.path, "rb") as file:
+            file.seek(batches[0][1])
+            self.assertEqual(json.loads(file.readline()), {"title": "Song 3"})
+        self.assertEqual(batches[-1][1], os.path.getsize(self.path))
+
+    def test_add_data_in_batches(self):
+        inserted = add_data(self.mongo_url, path=self.path, batch_size=2)
+
+        self.assertEqual(inserted, 7)
+        self.assertEqual(self.db.songs.count_documents({}), 7)
+
+    def test_add_data_resumes_from_checkpoint(self):
+        # Pretend that a previous import stopped after its first batch of 3 songs.
+        with open(self.path, "rb") as file:
+            _, offset = next(read_batches(file, 3))
+        with open(self.checkpoint, "w") as file:
+            file.write(str(offset))
+
+        inserted = add_data(
+            self.mongo_url, path=self.path, batch_size=3, checkpoint=self.checkpoint
+        )
+
+        self.assertEqual(inserted, 4)
+        self.assertEqual(
+            sorted(song["title"] for song in self.db.songs.find()),
+            ["Song 3", "Song 4", "Song 5", "Song 6"],
+        )
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_parse_song(self):
+        self.assertEqual(
+            parse_song(b'{"title": "Song", "difficulty": 2.5}'),
+            {"title": "Song", "difficulty": 2.5},
+        )
+        for line in (b"[1, 2]", b"{not json", b'{"title": 1}', b'{"level": "9"}'):
+            with self.assertRaises(ValueError):
+                parse_song(line)
+
+    def test_split_ranges(self):
+        ranges = split_ranges(self.path, 3)
+
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], os.path.getsize(self.path))
+        # The ranges are contiguous and every song is read exactly once.
+        songs = []
+        with open(self.path, "rb") as file:
+            for (start, end), (next_start, _) in zip(ranges, ranges[1:] + [(None, 0)]):
+                self.assertTrue(next_start is None or end == next_start)
+                file.seek(start)
+                for batch, _ in read_batches(file, 2, end=end):
+                    songs.extend(song["title"] for song in batch)
+        self.assertEqual(songs, [f"Song {number}" for number in range(7)])
+
+    def test_sync_data(self):
+        rated_id = self.db.songs.insert_one(
+            {
+                "artist": "A",
+                "title": "Changed",
+                "released": "2020",
+                "difficulty": 1,
+                "ratings": [5],
+                "ratings_count": 1,
+            }
+        ).inserted_id
+        self.db.songs.insert_one({"artist": "A", "title": "Same", "released": "2020"})
+
+        with open(self.path, "w") as file:
+            for song in (
+                {
+                    "artist": "A",
+                    "title": "Changed",
+                    "released": "2020",
+                    "difficulty": 2,
+                },
+                {"artist": "A", "title": "Same", "released": "2020"},
+                {"artist": "B", "title": "New", "released": "2021", "difficulty": 3},
+            ):
+                file.write(json.dumps(song) + "\n")
+
+        cache = Cache(
+            {"difficulty": {}, "search_words": {}, "ratings": {}, "versions": {}}
+        )
+        cache["versions"].set("catalogue", "before")
+        cache["difficulty"].set("histogram", DifficultyIndex([(1, 1)]))
+        cache["search_words"].set("same", [])
+
+        totals = sync_data(self.mongo_url, path=self.path, cache=cache)
+
+        self.assertEqual(totals, {"inserted": 1, "updated": 1, "unchanged": 1})
+        self.assertEqual(self.db.songs.count_documents({}), 3)
+
+        rated = self.db.songs.find_one({"_id": rated_id})
+        self.assertEqual(rated["difficulty"], 2)
+        self.assertEqual((rated["ratings"], rated["ratings_count"]), ([5], 1))
+
+        # Only the entries depending on the changed and new songs are dropped.
+        self.assertNotIn("histogram", cache["difficulty"])
+        self.assertIn("same", cache["search_words"])
+
+        # Syncing the same file again changes nothing.
+        totals = sync_data(self.mongo_url, path=self.path)
+        self.assertEqual(totals, {"inserted": 0, "updated": 0, "unchanged": 3})
+
+    def test_invalidate_cache(self):
+        cache = Cache(
+            {"difficulty": {}, "search_words": {}, "ratings": {}, "versions": {}}
+        )
+        cache["versions"].set("catalogue", "before")
+        cache["difficulty"].set("histogram", DifficultyIndex([(1, 1)]))
+        cache["ratings"].set("song", {"ratings_count": 1})
+        for search_word in ("yousicians", "in the night", "fastfinger"):
+            cache["search_words"].set(search_word, [])
+
+        invalidate_cache(
+            cache, [{"artist": "The Yousicians", "title": "Wishing In The Night"}]
+        )
+
+        # No difficulty changed, so the histogram is kept.
+        self.assertIn("histogram", cache["difficulty"])
+        self.assertIn("song", cache["ratings"])
+        self.assertEqual(cache["search_words"].keys(), ["fastfinger"])
+        self.assertNotEqual(cache["versions"].get("catalogue"), "before")
+
+    def test_add_data_parallel(self):
+        with open(self.path, "a") as file:
+            file.write('{"title": 42}\n')
+
+        inserted = add_data_parallel(
+            self.mongo_url, path=self.path, workers=2, batch_size=2
+        )
+
+        self.assertEqual(inserted, 7)
+        self.assertEqual(self.db.songs.count_documents({}), 7)
+
+    def tearDown(self) -> None:
+        delete_database(self.mongo_url)
+        self.tmp_dir.cleanup()